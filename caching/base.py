@@ -1,20 +1,29 @@
 from __future__ import unicode_literals
 
+import collections
 import functools
 import logging
-import hashlib
+import time
+import uuid
 
 import django
+from six.moves import cPickle as pickle
 
-from django.db import models
+from django.db import connections, models, router
 from django.db.models import signals
 from django.db.models.sql import query, EmptyResultSet
 from django.utils import encoding
 from django.core.cache.backends.base import DEFAULT_TIMEOUT
 
-from caching import config
+from caching import config, rows
 
+from .codec import DEFAULT_MIN_SIZE
+from .deferred import deferred
+from .dependencies import query_columns
+from .predicates import loads_instances, query_predicate, unique_lookup
 from .invalidation import invalidator
+from .querykey import compile_key, query_shape, shape_key
+from .refresh import recompute_early, stamp, timed, unstamp, untimed
 from .utils import flush_key, make_key, byid
 
 
@@ -31,6 +40,13 @@ except ImportError:
         def __iter__(self):
             return super(CachingQuerySet, self.queryset).iterator()
 
+try:
+    from django.db.models.fields.related_descriptors import ForwardManyToOneDescriptor
+except ImportError:
+    # Django < 1.9 resolves foreign keys with the default manager, see
+    # CachingManager.use_for_related_fields.
+    ForwardManyToOneDescriptor = None
+
 
 logger = logging.getLogger("caching")
 
@@ -46,27 +62,56 @@ class CachingManager(models.Manager):
     def contribute_to_class(self, cls, name):
         signals.post_save.connect(self.post_save, sender=cls)
         signals.post_delete.connect(self.post_delete, sender=cls)
+        signals.class_prepared.connect(self.class_prepared, sender=cls)
         return super(CachingManager, self).contribute_to_class(cls, name)
 
+    def class_prepared(self, sender, **kwargs):
+        # Resolve foreign keys through the cache, see CACHE_FOREIGN_KEYS.
+        if ForwardManyToOneDescriptor is None:
+            return
+        for field in sender._meta.local_fields:
+            if type(sender.__dict__.get(field.name)) is ForwardManyToOneDescriptor:
+                setattr(sender, field.name, CachingForeignKeyDescriptor(field))
+
     def post_save(self, instance, **kwargs):
         self.invalidate(
-            instance, is_new_instance=kwargs["created"], model_cls=kwargs["sender"]
+            instance,
+            is_new_instance=kwargs["created"],
+            model_cls=kwargs["sender"],
+            update_fields=kwargs.get("update_fields"),
+            using=kwargs.get("using"),
         )
 
     def post_delete(self, instance, **kwargs):
-        self.invalidate(instance)
+        self.invalidate(instance, using=kwargs.get("using"))
 
     def invalidate(self, *objects, **kwargs):
-        """Invalidate all the flush lists associated with ``objects``."""
-        invalidator.invalidate_objects(objects, **kwargs)
+        """
+        Invalidate all the flush lists associated with ``objects``.
+
+        With CACHE_INVALIDATE_ON_COMMIT, if ``using`` is in a transaction this
+        waits until it commits.  Within a bulk operation it waits for the end
+        of it.
+        """
+        using = kwargs.pop("using", None)
+        if objects and deferred.active(using):
+            model = kwargs.get("model_cls") or type(objects[0])
+            if deferred.saturated(using, model, len(objects)):
+                # The model gets invalidated as a whole anyway.
+                obj_keys, flush_keys = (), ()
+            else:
+                obj_keys, flush_keys = invalidator.object_keys(objects, **kwargs)
+            deferred.add(using, model, obj_keys, flush_keys, rows=len(objects))
+        else:
+            invalidator.invalidate_objects(objects, **kwargs)
 
     def raw(self, raw_query, params=None, *args, **kwargs):
         return CachingRawQuerySet(
             raw_query, self.model, params=params, using=self._db, *args, **kwargs
         )
 
-    def cache(self, timeout=DEFAULT_TIMEOUT):
-        return self.get_queryset().cache(timeout)
+    def cache(self, timeout=DEFAULT_TIMEOUT, lock_timeout=None, lock_wait=None):
+        return self.get_queryset().cache(timeout, lock_timeout, lock_wait)
 
     def no_cache(self):
         return self.cache(config.NO_CACHE)
@@ -80,10 +125,18 @@ class CachingModelIterable(ModelIterable):
     called to get an iterator over some database results.
     """
 
+    # How often results were too big to cache, by ceiling ("rows", "bytes").
+    ceiling_hits = collections.Counter()
+
+    # Number of rows pickled to estimate the size of a result.
+    size_sample = 10
+
     def __init__(self, queryset, *args, **kwargs):
         self.iter_function = kwargs.pop("iter_function", None)
         self.timeout = kwargs.pop("timeout", queryset.timeout)
         self.db = kwargs.pop("db", queryset.db)
+        self.lock_timeout = getattr(queryset, "lock_timeout", None)
+        self.lock_wait = getattr(queryset, "lock_wait", 0)
         super(CachingModelIterable, self).__init__(queryset, *args, **kwargs)
 
     def query_key(self):
@@ -96,18 +149,223 @@ class CachingModelIterable(ModelIterable):
         cross DB model saving among related objects.
         """
         query_db_string = "%s::db:%s" % (self.queryset.query_key(), self.db)
-        return "{}:{}".format(
+        key = "{}:{}".format(
             self.queryset.prefix_key, make_key(query_db_string, with_locale=False)
         )
+        return invalidator.version_key(key, self.queryset)
+
+    def cache_objects(self, objects, query_key, replace=False, fetched=None):
+        """
+        Cache query_key => objects, then update the flush lists.
 
-    def cache_objects(self, objects, query_key):
-        """Cache query_key => objects, then update the flush lists."""
+        ``fetched`` holds the {byid key: object} fetched by FETCH_BY_ID, to be
+        cached along with them; all of it is written as one fill.
+        """
         logger.debug("query_key: %s" % query_key)
         query_flush = self.queryset.flush_key()
         logger.debug("query_flush: %s" % query_flush)
 
-        invalidator.add(query_key, objects, timeout=self.timeout)
-        invalidator.cache_objects(self.queryset.model, objects, query_key, query_flush)
+        min_size = getattr(
+            self.queryset.model, "cache_compress_min_size", DEFAULT_MIN_SIZE
+        )
+        with invalidator.fill():
+            if fetched:
+                invalidator.set_many(fetched)
+            chunks = {}
+            if self.by_id():
+                value = rows.Ids(tuple(obj.pk for obj in objects))
+            elif config.CHUNK_SIZE and len(objects) > config.CHUNK_SIZE:
+                value, chunks = self.chunk(objects, query_key)
+                # Chunks go in first so the manifest never points at nothing.
+                invalidator.set_many(chunks, self.timeout, min_size)
+            else:
+                value = self.pack(objects)
+            if replace:
+                invalidator.set(query_key, stamp(value), self.timeout, min_size)
+            else:
+                invalidator.add(
+                    query_key, stamp(value), timeout=self.timeout, min_size=min_size
+                )
+            invalidator.cache_objects(
+                self.queryset.model,
+                objects,
+                query_key,
+                query_flush,
+                chunk_keys=chunks,
+                columns=self.columns(),
+                predicate=self.predicate(),
+                timeout=self.timeout,
+            )
+            if self.lock_timeout and config.MISS_LOCK_STALE:
+                # Outlives invalidation, for when someone else holds the lock.
+                invalidator.set(stale_key(query_key), value, self.timeout, min_size)
+
+    def lookup(self):
+        """
+        Return the (field, value) this query looks one object up by, with
+        CACHE_OBJECT_LOOKUPS.  See ``get_object``.
+        """
+        if (
+            not config.OBJECT_LOOKUPS
+            or self.iter_function is not None
+            or not isinstance(self.queryset.query, query.Query)
+        ):
+            return None
+        return unique_lookup(self.queryset.query)
+
+    def get_object(self, field, value):
+        """
+        Yield the object whose ``field`` is ``value``, read from its byid
+        entry rather than a cached query: every lookup of that object shares
+        the entry, and hits don't compile any SQL.  Lookups by another unique
+        field go through a small entry holding the primary key.
+        """
+        model, db = self.queryset.model, self.db
+        pk, keys = value, []
+        if not field.primary_key:
+            unique = "unique:%s:%s" % (field.name, model._cache_key(value, db))
+            keys.append(invalidator.version_key(make_key(unique), self.queryset))
+            pk = invalidator.get(keys[0])
+        if pk is not None:
+            obj = invalidator.get(byid(model._cache_key(pk, db)))
+            if obj is not None:
+                logger.debug("object hit: %s=%s" % (field.name, value))
+                obj.from_cache = True
+                yield obj
+                return
+
+        for obj in super(CachingModelIterable, self).__iter__():
+            obj.from_cache = False
+            with invalidator.fill():
+                invalidator.set_many({byid(obj): obj}, self.timeout)
+                if keys:
+                    invalidator.set(keys[0], obj.pk, self.timeout)
+                entries = dict((key, obj) for key in [byid(obj)] + keys)
+                invalidator.cache_object_keys(entries, self.timeout)
+            yield obj
+
+    def by_id(self):
+        """Whether results are cached as primary keys, with FETCH_BY_ID."""
+        return (
+            config.FETCH_BY_ID
+            and self.iter_function is None
+            and hasattr(self.queryset, "objects_by_id")
+        )
+
+    def columns(self):
+        """The fields the results depend on, with CACHE_FIELD_INVALIDATION."""
+        if not config.FIELD_INVALIDATION:
+            return None
+        return query_columns(self.queryset.query)
+
+    def predicate(self):
+        """The filters of the query, with CACHE_INVALIDATE_ON_CREATE='matching'."""
+        q = getattr(self.queryset, "query", None)
+        if config.CACHE_INVALIDATE_ON_CREATE != config.MATCHING or not isinstance(
+            q, query.Query
+        ):
+            return None
+        return query_predicate(q)
+
+    def pack(self, objects):
+        """
+        Store ``objects`` as compact rows if CACHE_COMPACT_ROWS is on and the
+        query only loads the model's own fields.
+        """
+        if not config.COMPACT_ROWS or self.iter_function is not None:
+            return objects
+        q = self.queryset.query
+        if q.select_related or q.annotations or q.extra:
+            return objects
+        return rows.pack(self.queryset.model, objects)
+
+    def chunk(self, objects, query_key):
+        """
+        Split ``objects`` into chunks of CACHE_CHUNK_SIZE.
+
+        Returns the manifest and a {chunk key: chunk} dict.  Chunk keys are
+        unique to this fill, so a manifest never mixes chunks of two fills.
+        """
+        size = config.CHUNK_SIZE
+        token = uuid.uuid4().hex[:8]
+        keys, chunks = [], {}
+        for i, start in enumerate(range(0, len(objects), size)):
+            key = "%s:chunk:%s:%d" % (query_key, token, i)
+            keys.append(key)
+            chunks[key] = self.pack(objects[start:start + size])
+        return rows.Manifest(keys, len(objects)), chunks
+
+    def iter_chunks(self, manifest, iterator, query_key):
+        """
+        Yield the objects of a chunked result, fetching CACHE_CHUNK_PREFETCH
+        chunks at a time as the consumer advances.
+
+        If a chunk has gone missing (evicted, or invalidated halfway through)
+        the query is run again and we carry on from where we were.
+        """
+        step = max(config.CHUNK_PREFETCH, 1)
+        yielded = 0
+        for start in range(0, len(manifest.keys), step):
+            keys = manifest.keys[start:start + step]
+            found = invalidator.get_many(keys)
+            for key in keys:
+                objects = rows.unpack(self.queryset.model, self.db, found.get(key))
+                if objects is None:
+                    logger.debug("missing chunk %s, refilling" % key)
+                    objects = list(iterator())
+                    for obj in objects:
+                        obj.from_cache = False
+                    if objects or config.CACHE_EMPTY_QUERYSETS:
+                        self.cache_objects(objects, query_key, replace=True)
+                    for obj in objects[yielded:]:
+                        yield obj
+                    return
+                prime_related(objects)
+                for obj in objects:
+                    obj.from_cache = True
+                    yielded += 1
+                    yield obj
+
+    def admit(self, objects, sample):
+        """
+        Check that ``objects`` is still small enough to be cached, given the
+        CACHE_MAX_ROWS and CACHE_MAX_BYTES ceilings.
+
+        The size in bytes is estimated from the pickled size of the first few
+        rows, which ``sample`` accumulates as [rows, bytes].
+        """
+        if config.MAX_ROWS is not None and len(objects) > config.MAX_ROWS:
+            self.ceiling_hits["rows"] += 1
+            return False
+        if config.MAX_BYTES is None:
+            return True
+        if sample[0] < self.size_sample:
+            sample[0] += 1
+            sample[1] += len(pickle.dumps(objects[-1], pickle.HIGHEST_PROTOCOL))
+        if sample[1] * len(objects) // sample[0] > config.MAX_BYTES:
+            self.ceiling_hits["bytes"] += 1
+            return False
+        return True
+
+    def wait_for_fill(self, query_key):
+        """
+        Wait for whoever holds the miss lock on ``query_key`` to cache it.
+
+        Polls the cache for up to ``lock_wait`` seconds, then falls back to
+        the stale copy (if any).  Returns None if we have to hit the database
+        after all.
+        """
+        deadline = time.time() + self.lock_wait
+        while time.time() < deadline:
+            time.sleep(config.MISS_LOCK_POLL)
+            cached = invalidator.get(query_key)
+            if cached is not None:
+                return cached
+        if config.MISS_LOCK_STALE:
+            cached = invalidator.get(stale_key(query_key))
+            if cached is not None:
+                logger.debug("serving stale copy of %s" % query_key)
+            return cached
 
     def __iter__(self):
         if self.iter_function is not None:
@@ -124,43 +382,118 @@ class CachingModelIterable(ModelIterable):
                 yield obj
             return
 
+        lookup = self.lookup()
+        if lookup is not None:
+            for obj in self.get_object(*lookup):
+                yield obj
+            return
+
         # Try to fetch from the cache.
         try:
             query_key = self.query_key()
         except query.EmptyResultSet:
             return
 
+        # Use the special FETCH_BY_ID iterator if configured.
+        fetch_by_id = self.by_id()
+        if fetch_by_id:
+            iterator = self.queryset.fetch_by_id
+
+        def refresh(objects):
+            if objects or config.CACHE_EMPTY_QUERYSETS:
+                self.cache_objects(objects, query_key, replace=True)
+
+        def unwrap(cached):
+            # Serve soft-expired results, refreshing them in the background.
+            compute = lambda: list(iterator())  # noqa
+            cached = unstamp(invalidator, query_key, cached, compute, refresh)
+            return rows.unpack(self.queryset.model, self.db, cached)
+
         cached = invalidator.get(query_key)
+        # Rows cached with an outdated schema have to be overwritten.
+        replace = cached is not None
+        cached = unwrap(cached)
+        locked = None
+        if cached is None and self.lock_timeout:
+            # Only one process gets to run the query, the others wait.
+            locked = invalidator.lock(query_key, self.lock_timeout)
+            if not locked:
+                cached = unwrap(self.wait_for_fill(query_key))
+        if isinstance(cached, rows.Ids):
+            logger.debug("cache hit: %s (%d ids)" % (query_key, len(cached.pks)))
+            cached = list(self.queryset.objects_by_id(list(cached.pks)))
+            prime_related(cached)
+            for obj in cached:
+                yield obj
+            return
+        if isinstance(cached, rows.Manifest):
+            logger.debug("cache hit: %s (%d chunks)" % (query_key, len(cached.keys)))
+            for obj in self.iter_chunks(cached, iterator, query_key):
+                yield obj
+            return
         if cached is not None:
             logger.debug("cache hit: %s" % query_key)
+            prime_related(cached)
             for obj in cached:
                 obj.from_cache = True
                 yield obj
             return
 
-        # Use the special FETCH_BY_ID iterator if configured.
-        if config.FETCH_BY_ID and hasattr(self.queryset, "fetch_by_id"):
-            iterator = self.queryset.fetch_by_id
-
         # No cached results. Do the database query, and cache it once we have
-        # all the objects.
-        to_cache = []
-        for obj in iterator():
-            obj.from_cache = False
-            to_cache.append(obj)
-            yield obj
-        if to_cache or config.CACHE_EMPTY_QUERYSETS:
-            self.cache_objects(to_cache, query_key)
+        # all the objects, unless there are too many of them: then we stop
+        # buffering and just stream them through.
+        to_cache, sample = [], [0, 0]
+        fetched = {}
+
+        def store(objects):
+            # Objects read by fetch_by_id are cached in the same fill as the
+            # result, or as they come if it isn't going to be cached.
+            if to_cache is None:
+                self.queryset.cache_by_id(objects)
+            else:
+                fetched.update(objects)
+
+        if fetch_by_id:
+            iterator = functools.partial(self.queryset.fetch_by_id, store)
+        try:
+            for obj in iterator():
+                obj.from_cache = False
+                if to_cache is not None:
+                    to_cache.append(obj)
+                    if not self.admit(to_cache, sample):
+                        logger.debug("too big to cache: %s" % query_key)
+                        to_cache = None
+                        if fetched:
+                            self.queryset.cache_by_id(fetched)
+                            fetched.clear()
+                        if locked:
+                            # Don't keep the others waiting for nothing.
+                            invalidator.unlock(query_key, locked)
+                            locked = None
+                yield obj
+            if to_cache is not None and (to_cache or config.CACHE_EMPTY_QUERYSETS):
+                self.cache_objects(
+                    to_cache, query_key, replace=replace, fetched=fetched
+                )
+        finally:
+            if locked:
+                invalidator.unlock(query_key, locked)
 
 
 class CachingQuerySet(models.query.QuerySet):
 
     _default_timeout_pickle_key = "__DEFAULT_TIMEOUT__"
 
+    # Batches of objects looked up by id, and how many were hits and misses.
+    fetch_stats = collections.Counter()
+
     def __init__(self, *args, **kw):
         super(CachingQuerySet, self).__init__(*args, **kw)
         self.timeout = DEFAULT_TIMEOUT
+        self.lock_timeout = config.MISS_LOCK_TIMEOUT
+        self.lock_wait = config.MISS_LOCK_WAIT
         self._iterable_class = CachingModelIterable
+        self._query_key_memo = None
 
     def __getstate__(self):
         """
@@ -172,11 +505,13 @@ class CachingQuerySet(models.query.QuerySet):
         state.update(self.__dict__)
         if self.timeout == DEFAULT_TIMEOUT:
             state["timeout"] = self._default_timeout_pickle_key
+        state["_query_key_memo"] = None
         return state
 
     def __setstate__(self, state):
         """ Safely unpickle our timeout if it's a DEFAULT_TIMEOUT. """
         self.__dict__.update(state)
+        self.__dict__.setdefault("_query_key_memo", None)
         if self.timeout == self._default_timeout_pickle_key:
             self.timeout = DEFAULT_TIMEOUT
 
@@ -189,45 +524,217 @@ class CachingQuerySet(models.query.QuerySet):
         return "qs:{}.{}".format(meta.app_label, meta.model_name)
 
     def query_key(self):
-        clone = self.query.clone()
-        sql, params = clone.get_compiler(using=self.db).as_sql()
-        return hashlib.md5(encoding.smart_bytes(sql % params)).hexdigest()
-
-    def iterator(self):
-        return self._iterable_class(self)
+        """
+        Return a hash identifying this query, compiling it only if needed.
 
-    def fetch_by_id(self):
+        Simple queries are matched against the query shape cache and keyed
+        from the cached SQL template plus their parameters; the key is
+        memoized on the queryset by shape, so changes made to the query in
+        place are seen.  Anything else is compiled every time.
+        """
+        shape = None
+        if config.QUERY_SHAPE_CACHE_SIZE:
+            shape = query_shape(self.query, self.db)
+        if shape is None:
+            return compile_key(self.query, self.db)
+        memo = self._query_key_memo
+        if memo is not None and memo[0] == shape:
+            return memo[1]
+        key = shape_key(self.query, self.db, shape)
+        self._query_key_memo = (shape, key)
+        return key
+
+    def iterator(self, chunk_size=None):
+        # Fetch rows in chunks (with server-side cursors where available) the
+        # way QuerySet.iterator() does, so uncached results can be streamed.
+        kwargs = {}
+        if django.VERSION[:2] >= (1, 11):
+            settings_dict = connections[self.db].settings_dict
+            kwargs["chunked_fetch"] = not settings_dict.get(
+                "DISABLE_SERVER_SIDE_CURSORS"
+            )
+        if chunk_size is not None:
+            kwargs["chunk_size"] = chunk_size
+        return self._iterable_class(self, **kwargs)
+
+    def update(self, **kwargs):
+        """Update the rows and invalidate them, in one batch."""
+        # Read the rows from, and tie the batch to, the database written to,
+        # as Django's update() does.
+        self._for_write = True
+        with deferred.collect(self.db):
+            pks = self._invalidate_rows(self)
+            rows = super(CachingQuerySet, self).update(**kwargs)
+            fks = [f for f in self._fk_fields() if set(kwargs) & {f.name, f.attname}]
+            if pks is not None and fks:
+                # The objects they point to now have to be invalidated too.
+                qs = self.model._base_manager.using(self.db).filter(pk__in=pks)
+                self._invalidate_rows(qs, count=0)
+        return rows
+
+    update.alters_data = True
+
+    def delete(self):
+        # The objects deleted are invalidated by post_delete, in one batch.
+        with deferred.collect(router.db_for_write(self.model, **self._hints)):
+            return super(CachingQuerySet, self).delete()
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = super(CachingQuerySet, self).bulk_create(objs, *args, **kwargs)
+        if objs and hasattr(self.model, "_cache_key"):
+            if deferred.saturated(self.db, self.model, len(objs)):
+                obj_keys, flush_keys = (), ()
+            else:
+                obj_keys, flush_keys = invalidator.object_keys(
+                    objs, is_new_instance=True, model_cls=self.model
+                )
+            deferred.add(self.db, self.model, obj_keys, flush_keys, rows=len(objs))
+        return objs
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        objs = list(objs)
+        self._for_write = True
+        with deferred.collect(self.db):
+            rows = len(objs)
+            fks = [f for f in self._fk_fields() if f.name in fields]
+            if fks and not deferred.saturated(self.db, self.model, rows):
+                # Objects they pointed to before have to be invalidated too.
+                self._invalidate_rows(self.filter(pk__in=[o.pk for o in objs]))
+                rows = 0
+            result = super(CachingQuerySet, self).bulk_update(
+                objs, fields, *args, **kwargs
+            )
+            if objs and hasattr(self.model, "_cache_key"):
+                if deferred.saturated(self.db, self.model, rows):
+                    obj_keys, flush_keys = (), ()
+                else:
+                    obj_keys, flush_keys = invalidator.object_keys(
+                        objs, update_fields=fields
+                    )
+                deferred.add(self.db, self.model, obj_keys, flush_keys, rows=rows)
+        return result
+
+    def _fk_fields(self):
+        if not hasattr(self.model, "_fk_fields"):
+            return []
+        return self.model._fk_fields()
+
+    def _invalidate_rows(self, qs, count=None):
+        """
+        Queue invalidation of the rows matched by ``qs``, read with a single
+        ``values_list`` query.  Returns their pks, or None if there are more
+        than CACHE_BULK_INVALIDATE_MAX_ROWS (the model gets invalidated as a
+        whole then, so we stop reading).
+        """
+        if not hasattr(self.model, "_row_keys"):
+            return None
+        if deferred.saturated(self.db, self.model):
+            # Already invalidated as a whole.
+            return None
+        limit = config.BULK_INVALIDATE_MAX_ROWS
+        rows = qs.order_by().values_list("pk", *[f.attname for f in self._fk_fields()])
+        if limit is not None:
+            rows = rows[:limit + 1]
+        rows = list(rows)
+        count = len(rows) if count is None else count
+        if deferred.saturated(self.db, self.model, count):
+            deferred.add(self.db, self.model, (), (), rows=count)
+            return None
+        obj_keys, flush_keys = self.model._row_keys(rows, self.db)
+        deferred.add(self.db, self.model, obj_keys, flush_keys, rows=count)
+        return [row[0] for row in rows]
+
+    def fetch_by_id(self, store=None):
         """
         Run two queries to get objects: one for the ids, one for id__in=ids.
 
         After getting ids from the first query we can try cache.get_many to
         reuse objects we've already seen.  Then we fetch the remaining items
         from the db, and put those in the cache.  This prevents cache
-        duplication.
+        duplication.  See ``objects_by_id`` for ``store``.
         """
         # Include columns from extra since they could be used in the query's
         # order_by.
         vals = self.values_list("pk", *list(self.query.extra.keys()))
         pks = [val[0] for val in vals]
-        keys = dict((byid(self.model._cache_key(pk, self.db)), pk) for pk in pks)
-        cached = dict(
-            (k, v) for k, v in list(invalidator.get_many(keys).items()) if v is not None
-        )
+        for obj in self.objects_by_id(pks, store):
+            yield obj
 
-        # Pick up the objects we missed.
-        missed = [pk for key, pk in list(keys.items()) if key not in cached]
-        if missed:
-            others = self.fetch_missed(missed)
-            # Put the fetched objects back in cache.
-            new = dict((byid(o), o) for o in others)
-            invalidator.set_many(new)
-        else:
-            new = {}
+    def objects_by_id(self, pks, store=None):
+        """
+        Yield the objects with primary keys ``pks``, in order, taking them
+        from the cache where possible.
+
+        Objects are looked up, and those we missed read from the database,
+        CACHE_FETCH_BY_ID_BATCH_SIZE at a time.  Each batch of objects read
+        is cached right away (see ``cache_by_id``), or passed to ``store`` as
+        a {byid key: object} dict if given.  Objects that no longer exist are skipped.
+
+        The hit ratio of every batch is logged, and added up in
+        ``fetch_stats``.
+        """
+        size = config.FETCH_BY_ID_BATCH_SIZE
+        for start in range(0, len(pks), size):
+            batch = pks[start:start + size]
+            keys = dict((byid(self.model._cache_key(pk, self.db)), pk) for pk in batch)
+            objects = {}
+            for key, obj in invalidator.get_many(keys).items():
+                if obj is not None:
+                    obj.from_cache = True
+                    objects[keys[key]] = obj
+
+            # Pick up the objects we missed.
+            missed = [pk for pk in keys.values() if pk not in objects]
+            self.fetch_stats.update(batches=1, hits=len(objects), misses=len(missed))
+            logger.debug(
+                "fetch by id: %d/%d hits (%d%%)"
+                % (len(objects), len(keys), 100 * len(objects) // len(keys))
+            )
+            if missed:
+                new = {}
+                for obj in self.fetch_missed(missed):
+                    obj.from_cache = False
+                    objects[obj.pk] = obj
+                    new[byid(obj)] = obj
+                (store or self.cache_by_id)(new)
+
+            for pk in batch:
+                if pk in objects:
+                    yield objects[pk]
+
+    def cache_by_id(self, objects):
+        """
+        Cache a {byid key: object} dict of objects on their own, invalidated
+        with each object.
+        """
+        with invalidator.fill():
+            invalidator.set_many(objects, self.timeout)
+            invalidator.cache_object_keys(objects, self.timeout)
 
-        # Use pks to return the objects in the correct order.
-        objects = dict((o.pk, o) for o in list(cached.values()) + list(new.values()))
-        for pk in pks:
-            yield objects[pk]
+    def in_bulk(self, id_list=None, **kwargs):
+        """
+        Like ``QuerySet.in_bulk``, but with CACHE_OBJECT_LOOKUPS look the
+        objects up by primary key in the cache first: multi-gets on their
+        byid entries, then queries for the missing ones, which get cached one
+        by one.  Any other list of ids reuses them.  See ``objects_by_id``.
+        """
+        field_name = kwargs.get("field_name", "pk")
+        pk = self.model._meta.pk
+        if (
+            not config.OBJECT_LOOKUPS
+            or id_list is None
+            or field_name not in ("pk", pk.name)
+            or self.timeout == config.NO_CACHE
+            or self.query.where.children
+            or not self.query.can_filter()
+            or not loads_instances(self.query)
+        ):
+            return super(CachingQuerySet, self).in_bulk(id_list, **kwargs)
+        pks = [pk.to_python(value) for value in id_list]
+        return dict((obj.pk, obj) for obj in self.objects_by_id(pks))
 
     def fetch_missed(self, pks):
         # Reuse the queryset but get a clean query.
@@ -253,9 +760,20 @@ class CachingQuerySet(models.query.QuerySet):
 
         return cached_with(self, super_count, query_string, config.TIMEOUT)
 
-    def cache(self, timeout=DEFAULT_TIMEOUT):
+    def cache(self, timeout=DEFAULT_TIMEOUT, lock_timeout=None, lock_wait=None):
+        """
+        Set the cache timeout for this queryset.
+
+        ``lock_timeout`` turns on the miss lock: on a cache miss only one
+        process runs the query while the others wait up to ``lock_wait``
+        seconds for it to be cached.  A ``lock_timeout`` of 0 turns it off.
+        """
         qs = self._clone()
         qs.timeout = timeout
+        if lock_timeout is not None:
+            qs.lock_timeout = lock_timeout
+        if lock_wait is not None:
+            qs.lock_wait = lock_wait
         return qs
 
     def no_cache(self):
@@ -264,12 +782,21 @@ class CachingQuerySet(models.query.QuerySet):
     def _clone(self, *args, **kw):
         qs = super(CachingQuerySet, self)._clone(*args, **kw)
         qs.timeout = self.timeout
+        qs.lock_timeout = self.lock_timeout
+        qs.lock_wait = self.lock_wait
+        # Only reused by the clone if its query still has the same shape.
+        qs._query_key_memo = self._query_key_memo
         return qs
 
 
 class CachingMixin(object):
     """Inherit from this class to get caching and invalidation helpers."""
 
+    # Size in bytes above which cached querysets of this model get
+    # compressed; None never compresses them.  Defaults to the
+    # CACHE_COMPRESS_MIN_SIZE setting.
+    cache_compress_min_size = DEFAULT_MIN_SIZE
+
     def flush_key(self):
         return "{}.{}:{}".format(
             self._meta.app_label, self._meta.model_name, flush_key(self)
@@ -312,19 +839,8 @@ class CachingMixin(object):
 
     def _cache_keys(self, incl_db=True):
         """Return the cache key for self plus all related foreign keys."""
-        fks = dict(
-            (f, getattr(self, f.attname))
-            for f in self._meta.fields
-            if isinstance(f, models.ForeignKey)
-        )
-
-        keys = []
-        for fk, val in list(fks.items()):
-            related_model = self._get_fk_related_model(fk)
-            if val is not None and hasattr(related_model, "_cache_key"):
-                keys.append(
-                    related_model._cache_key(val, incl_db and self._state.db or None)
-                )
+        fks = dict((f, getattr(self, f.attname)) for f in self._fk_fields())
+        keys = self._fk_cache_keys(fks, incl_db and self._state.db or None)
 
         cache_keys = (self.get_cache_key(incl_db=incl_db),) + tuple(keys)
 
@@ -334,13 +850,134 @@ class CachingMixin(object):
         """Return the flush key for self plus all related foreign keys."""
         return map(flush_key, self._cache_keys(incl_db=False))
 
-    def _get_fk_related_model(self, fk):
+    @classmethod
+    def _fk_fields(cls):
+        return [f for f in cls._meta.fields if isinstance(f, models.ForeignKey)]
+
+    @classmethod
+    def _fk_cache_keys(cls, fks, db=None):
+        """Return the cache keys of the objects in a {field: value} dict."""
+        keys = []
+        for fk, val in list(fks.items()):
+            related_model = cls._get_fk_related_model(fk)
+            if val is not None and hasattr(related_model, "_cache_key"):
+                keys.append(related_model._cache_key(val, db))
+        return keys
+
+    @classmethod
+    def _row_keys(cls, rows, db):
+        """
+        Return the (object keys, flush keys) of ``rows`` of (pk, foreign
+        key values...), in ``_fk_fields`` order, without loading instances.
+        """
+        fields = cls._fk_fields()
+        obj_keys, flush_keys = [], []
+        for row in rows:
+            fks = dict(zip(fields, row[1:]))
+            obj_keys.append(cls._cache_key(row[0], db))
+            obj_keys.extend(cls._fk_cache_keys(fks, db))
+            flush_keys.append(flush_key(cls._cache_key(row[0])))
+            flush_keys.extend(map(flush_key, cls._fk_cache_keys(fks)))
+        return obj_keys, flush_keys
+
+    @staticmethod
+    def _get_fk_related_model(fk):
         if django.VERSION[0] >= 2:
             return fk.remote_field.model
 
         return fk.rel.to
 
 
+if ForwardManyToOneDescriptor is not None:
+
+    class CachingForeignKeyDescriptor(ForwardManyToOneDescriptor):
+        """
+        With CACHE_FOREIGN_KEYS, read the object a foreign key points to from
+        its byid entry, filled once and shared by everything pointing to it.
+        """
+
+        def get_object(self, instance):
+            model = self.field.related_model
+            if not cached_relation(self.field):
+                return super(CachingForeignKeyDescriptor, self).get_object(instance)
+            db = router.db_for_read(model, instance=instance)
+            pk = getattr(instance, self.field.attname)
+            objects = list(CachingQuerySet(model, using=db).objects_by_id([pk]))
+            if not objects:
+                raise model.DoesNotExist(
+                    "%s matching query does not exist." % model._meta.object_name
+                )
+            return objects[0]
+
+
+def cached_relation(field):
+    """
+    Whether to resolve ``field``, a forward relation, through the cache: the
+    related model is cached and pointed to by its primary key.
+    """
+    return (
+        config.FOREIGN_KEYS
+        and not field.many_to_many
+        and hasattr(field.related_model, "_cache_key")
+        and field.target_field.primary_key
+    )
+
+
+def prime_related(objects):
+    """
+    Resolve the foreign keys of ``objects`` through the cache ahead of time:
+    one multi-get for the byid entries of everything they point to, and one
+    query per model for those we miss.  Deferred foreign keys are left alone:
+    reading them would load the object again, and prime it again.
+    """
+    if not objects or not config.FOREIGN_KEYS or ForwardManyToOneDescriptor is None:
+        return
+    model = type(objects[0])
+    fields = [
+        f
+        for f in getattr(model, "_fk_fields", lambda: [])()
+        if type(getattr(model, f.name, None)) is CachingForeignKeyDescriptor
+        and cached_relation(f)
+    ]
+    wanted = collections.defaultdict(list)
+    for obj in objects:
+        deferred_fields = obj.get_deferred_fields()
+        for field in fields:
+            if field.attname in deferred_fields:
+                continue
+            pk = getattr(obj, field.attname)
+            if pk is not None and not getattr(model, field.name).is_cached(obj):
+                db = router.db_for_read(field.related_model, instance=obj)
+                wanted[field.related_model, db, pk].append((obj, field))
+    if not wanted:
+        return
+    keys = dict((byid(m._cache_key(pk, db)), (m, db, pk)) for m, db, pk in wanted)
+    found = dict((keys[k], v) for k, v in invalidator.get_many(keys).items() if v is not None)
+
+    missed = collections.defaultdict(list)
+    for key in wanted:
+        if key not in found:
+            missed[key[:2]].append(key[2])
+    for (related, db), pks in missed.items():
+        queryset = CachingQuerySet(related, using=db)
+        new = dict((o.pk, o) for o in queryset.fetch_missed(pks))
+        queryset.cache_by_id(dict((byid(o), o) for o in new.values()))
+        found.update(((related, db, pk), o) for pk, o in new.items())
+
+    for key, pointers in wanted.items():
+        if key in found:
+            for obj, field in pointers:
+                set_cached_value(field, obj, found[key])
+
+
+def set_cached_value(field, instance, value):
+    if hasattr(field, "set_cached_value"):
+        field.set_cached_value(instance, value)
+    else:
+        # Django < 2.0.
+        setattr(instance, field.get_cache_name(), value)
+
+
 class CachingRawQuerySet(models.query.RawQuerySet):
     def __init__(self, *args, **kw):
         timeout = kw.pop("timeout", DEFAULT_TIMEOUT)
@@ -363,21 +1000,47 @@ class CachingRawQuerySet(models.query.RawQuerySet):
         return self.raw_query % tuple(self.params)
 
 
+def stale_key(query_key):
+    return "stale:%s" % query_key
+
+
 def _function_cache_key(key):
     return make_key("f:%s" % key, with_locale=True)
 
 
-def cached(function, key_, duration=DEFAULT_TIMEOUT):
-    """Only calls the function if ``key`` is not already in the cache."""
+def cached(function, key_, duration=DEFAULT_TIMEOUT, flush_key=None):
+    """
+    Only calls the function if ``key`` is not already in the cache.
+
+    On a miss the key is added to the ``flush_key`` flush list, if given, so
+    hits don't write anything.
+    """
     key = _function_cache_key(key_)
-    val = invalidator.get(key)
-    if val is None:
-        logger.debug("cache miss for %s" % key)
+
+    def compute():
+        start = time.time()
         val = function()
-        invalidator.set(key, val, duration)
+        return timed(val, time.time() - start, _timeout_seconds(duration))
+
+    def store(val):
+        invalidator.set(key, stamp(val), duration)
+
+    val = unstamp(invalidator, key, invalidator.get(key), compute, store)
+    if val is None or recompute_early(val):
+        logger.debug("cache miss for %s" % key)
+        if flush_key is not None:
+            invalidator.add_to_flush_list({flush_key: [key]}, duration)
+        val = compute()
+        store(val)
     else:
         logger.debug("cache hit for %s" % key)
-    return val
+    return untimed(val)
+
+
+def _timeout_seconds(duration):
+    if duration == DEFAULT_TIMEOUT:
+        return getattr(invalidator.cache, "default_timeout", None)
+    return duration
 
 
 def cached_with(obj, f, f_key, timeout=DEFAULT_TIMEOUT):
@@ -390,9 +1053,9 @@ def cached_with(obj, f, f_key, timeout=DEFAULT_TIMEOUT):
         return f()
 
     key = "%s:%s" % tuple(map(encoding.smart_text, (f_key, obj_key)))
-    # Put the key generated in cached() into this object's flush list.
-    invalidator.add_to_flush_list({obj.flush_key(): [_function_cache_key(key)]})
-    return cached(f, key, timeout)
+    key = invalidator.version_key(key, obj)
+    # cached() puts its key into this object's flush list on a miss.
+    return cached(f, key, timeout, flush_key=obj.flush_key())
 
 
 class cached_method(object):
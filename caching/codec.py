@@ -0,0 +1,56 @@
+from __future__ import unicode_literals
+
+import collections
+import zlib
+
+from six.moves import cPickle as pickle
+
+from caching import config
+
+# Encoded values are pickled by us and start with a two byte header, so they
+# can sit next to values stored as they are.
+PLAIN = b"\xcc\x00"
+ZLIB = b"\xcc\x01"
+
+# Stands for "whatever CACHE_COMPRESS_MIN_SIZE says".
+DEFAULT_MIN_SIZE = object()
+
+
+class Codec(object):
+    """
+    Compress cached values bigger than a size threshold with zlib.
+
+    ``stats`` counts what was written and read in each format, and the bytes
+    before/after compression.
+    """
+
+    def __init__(self):
+        self.stats = collections.Counter()
+
+    def encode(self, value, min_size=DEFAULT_MIN_SIZE):
+        if min_size is DEFAULT_MIN_SIZE:
+            min_size = config.COMPRESS_MIN_SIZE
+        if min_size is None or value is None:
+            return value
+        payload = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(payload) >= min_size:
+            compressed = zlib.compress(payload, config.COMPRESS_LEVEL)
+            if len(compressed) < len(payload):
+                self.stats["compressed"] += 1
+                self.stats["raw_bytes"] += len(payload)
+                self.stats["compressed_bytes"] += len(compressed)
+                return ZLIB + compressed
+        self.stats["plain"] += 1
+        return PLAIN + payload
+
+    def decode(self, value):
+        if not isinstance(value, bytes):
+            return value
+        header = value[:2]
+        if header == ZLIB:
+            self.stats["compressed_hits"] += 1
+            return pickle.loads(zlib.decompress(value[2:]))
+        if header == PLAIN:
+            self.stats["plain_hits"] += 1
+            return pickle.loads(value[2:])
+        return value
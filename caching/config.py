@@ -2,10 +2,27 @@ from django.conf import settings
 
 NO_CACHE = -1
 WHOLE_MODEL = "whole-model"
+MATCHING = "matching"
 
 
 HASH_KEY = getattr(settings, "HASH_KEY", False)
 FETCH_BY_ID = getattr(settings, "FETCH_BY_ID", False)
+# Objects missing from the cache are read from the database this many at a
+# time with FETCH_BY_ID.
+FETCH_BY_ID_BATCH_SIZE = getattr(settings, "CACHE_FETCH_BY_ID_BATCH_SIZE", 500)
+# Serve queries looking one object up by primary key or a unique field, and
+# in_bulk() by primary key, from that object's own cache entry, shared by all
+# of them.
+OBJECT_LOOKUPS = getattr(settings, "CACHE_OBJECT_LOOKUPS", False)
+# Resolve foreign keys through the related object's cache entry, and prime
+# those of cached results with one multi-get.
+FOREIGN_KEYS = getattr(settings, "CACHE_FOREIGN_KEYS", False)
+# Multi-gets and multi-sets go to the backend this many keys at a time (None
+# for all at once), on up to this many threads where the client allows it:
+# True or False, or None to only share django-redis' client between threads.
+MULTI_CHUNK_SIZE = getattr(settings, "CACHE_MULTI_CHUNK_SIZE", None)
+MULTI_THREADS = getattr(settings, "CACHE_MULTI_THREADS", 4)
+MULTI_CONCURRENT = getattr(settings, "CACHE_MULTI_CONCURRENT", None)
 CACHE_PREFIX = getattr(settings, "CACHE_PREFIX", "ormcache:")
 FLUSH_PREFIX = getattr(settings, "FLUSH_PREFIX", "flush:")
 CACHE_EMPTY_QUERYSETS = getattr(settings, "CACHE_EMPTY_QUERYSETS", False)
@@ -15,8 +32,79 @@ CACHE_MACHINE_NO_INVALIDATION = getattr(
     settings, "CACHE_MACHINE_NO_INVALIDATION", False
 )
 CACHE_MACHINE_USE_REDIS = getattr(settings, "CACHE_MACHINE_USE_REDIS", False)
+# Invalidate with generation numbers embedded in cache keys instead of flush
+# lists, whatever the backend.
+CACHE_MACHINE_USE_GENERATIONS = getattr(
+    settings, "CACHE_MACHINE_USE_GENERATIONS", False
+)
+# Hold back invalidations made inside a transaction until it commits.
+INVALIDATE_ON_COMMIT = getattr(settings, "CACHE_INVALIDATE_ON_COMMIT", False)
+# Invalidate a model as a whole when a bulk operation (or a transaction, see
+# above) changes more than this many of its rows. None never does; setting it
+# keeps model flush lists up to date, like CACHE_INVALIDATE_ON_CREATE does.
+BULK_INVALIDATE_MAX_ROWS = getattr(settings, "CACHE_BULK_INVALIDATE_MAX_ROWS", None)
+# Record the fields cached queries depend on, so saves with update_fields only
+# invalidate the queries using one of the fields saved.
+FIELD_INVALIDATION = getattr(settings, "CACHE_FIELD_INVALIDATION", False)
+# Flush lists (outside of Redis) longer than this are invalidated, with their
+# model as a whole, rather than grown further. None for no limit.
+FLUSH_LIST_MAX_SIZE = getattr(settings, "CACHE_FLUSH_LIST_MAX_SIZE", None)
+# Spread each flush list (outside of Redis) over this many keys, and update
+# them with compare-and-set (pylibmc or pymemcache backends), so concurrent
+# fills don't overwrite each other's entries.
+FLUSH_LIST_SHARDS = getattr(settings, "CACHE_FLUSH_LIST_SHARDS", 1)
+FLUSH_LIST_CAS = getattr(settings, "CACHE_FLUSH_LIST_CAS", False)
+# Expand and delete flush lists with a single Lua script when using Redis,
+# visiting at most REDIS_FLUSH_LIMIT lists per call.
+REDIS_FLUSH_SCRIPT = getattr(settings, "CACHE_REDIS_FLUSH_SCRIPT", False)
+REDIS_FLUSH_LIMIT = getattr(settings, "CACHE_REDIS_FLUSH_LIMIT", 1000)
+# Send all the writes of a cache fill in one Redis pipeline.
+REDIS_FILL_PIPELINE = getattr(settings, "CACHE_REDIS_FILL_PIPELINE", False)
+# Number of distinct query shapes whose SQL template is kept in-process so
+# query keys can be built without compiling the query. 0 disables it.
+QUERY_SHAPE_CACHE_SIZE = getattr(settings, "CACHE_QUERY_SHAPE_SIZE", 1000)
+# Optional process-local cache in front of the backend. Invalidations are
+# broadcast to every process over Redis pub/sub when CACHE_MACHINE_USE_REDIS
+# is on; otherwise other processes only drop entries on timeout.
+LOCAL_CACHE_SIZE = getattr(settings, "CACHE_LOCAL_SIZE", 0)
+LOCAL_CACHE_TIMEOUT = getattr(settings, "CACHE_LOCAL_TIMEOUT", 5)
+LOCAL_CACHE_CHANNEL = getattr(
+    settings, "CACHE_LOCAL_CHANNEL", "cache-machine:invalidate"
+)
+# Miss lock (dogpile protection): seconds the lock is held at most, None to
+# disable it; how long other processes wait for the result, and how often
+# they check; whether to keep a copy of results to serve while waiting.
+MISS_LOCK_TIMEOUT = getattr(settings, "CACHE_MISS_LOCK_TIMEOUT", None)
+MISS_LOCK_WAIT = getattr(settings, "CACHE_MISS_LOCK_WAIT", 1)
+MISS_LOCK_POLL = getattr(settings, "CACHE_MISS_LOCK_POLL", 0.05)
+MISS_LOCK_STALE = getattr(settings, "CACHE_MISS_LOCK_STALE", False)
+# Stale-while-revalidate: seconds after which cached results are refreshed in
+# the background while the old value keeps being served (None disables it),
+# and the size of the thread pool and queue doing the refreshing.
+REFRESH_AFTER = getattr(settings, "CACHE_REFRESH_AFTER", None)
+REFRESH_THREADS = getattr(settings, "CACHE_REFRESH_THREADS", 2)
+REFRESH_QUEUE_SIZE = getattr(settings, "CACHE_REFRESH_QUEUE_SIZE", 100)
+# Probabilistic early recomputation of cached() values (XFetch); higher
+# values recompute earlier. None disables it.
+XFETCH_BETA = getattr(settings, "CACHE_XFETCH_BETA", None)
+# Cache querysets as tuples of field values rather than pickled instances.
+COMPACT_ROWS = getattr(settings, "CACHE_COMPACT_ROWS", False)
+# Cached values whose pickle is at least this many bytes get compressed with
+# zlib at the given level. None disables compression.
+COMPRESS_MIN_SIZE = getattr(settings, "CACHE_COMPRESS_MIN_SIZE", None)
+COMPRESS_LEVEL = getattr(settings, "CACHE_COMPRESS_LEVEL", 6)
+# Results with more objects than this are cached in chunks of this size
+# behind a small manifest, and read back a few chunks at a time. None keeps
+# every result in a single key.
+CHUNK_SIZE = getattr(settings, "CACHE_CHUNK_SIZE", None)
+CHUNK_PREFETCH = getattr(settings, "CACHE_CHUNK_PREFETCH", 1)
+# Results bigger than this many rows, or (estimated) pickled bytes, aren't
+# cached: they're streamed through instead of being buffered. None for no
+# limit.
+MAX_ROWS = getattr(settings, "CACHE_MAX_ROWS", None)
+MAX_BYTES = getattr(settings, "CACHE_MAX_BYTES", None)
 
-_invalidate_on_create_values = (None, WHOLE_MODEL)
+_invalidate_on_create_values = (None, WHOLE_MODEL, MATCHING)
 if CACHE_INVALIDATE_ON_CREATE not in _invalidate_on_create_values:
     raise ValueError(
         "CACHE_INVALIDATE_ON_CREATE must be one of: "
@@ -0,0 +1,150 @@
+from __future__ import unicode_literals
+
+import collections
+import contextlib
+import logging
+import threading
+
+from django.db import connections, transaction
+
+from caching import config
+from caching.invalidation import invalidator
+
+logger = logging.getLogger("caching.deferred")
+
+
+class Batch(object):
+    """
+    Object and flush keys to invalidate together, by model.
+
+    Models with more than CACHE_BULK_INVALIDATE_MAX_ROWS rows in the batch
+    are invalidated as a whole instead, through their model flush list: their
+    row keys are dropped, and callers stop collecting them (see ``over``).
+    """
+
+    def __init__(self):
+        self.keys = collections.defaultdict(lambda: (set(), set()))
+        self.rows = collections.Counter()
+
+    def over(self, model):
+        """Whether ``model`` has passed the row limit in this batch."""
+        limit = config.BULK_INVALIDATE_MAX_ROWS
+        return (
+            limit is not None
+            and self.rows[model] > limit
+            and hasattr(model, "model_flush_key")
+        )
+
+    def add(self, model, obj_keys, flush_keys, rows=1):
+        self.rows[model] += rows
+        if self.over(model):
+            self.keys.pop(model, None)
+            return
+        keys = self.keys[model]
+        keys[0].update(obj_keys)
+        keys[1].update(flush_keys)
+
+    def update(self, other):
+        for model, rows in other.rows.items():
+            obj_keys, flush_keys = other.keys.get(model, ((), ()))
+            self.add(model, obj_keys, flush_keys, rows)
+
+    def run(self):
+        obj_keys, flush_keys = set(), set()
+        for model in self.rows:
+            if self.over(model):
+                logger.debug("invalidating all of %s" % model.__name__)
+                flush_keys.update(invalidator.model_keys(model))
+            elif model in self.keys:
+                obj_keys.update(self.keys[model][0])
+                flush_keys.update(self.keys[model][1])
+        if obj_keys or flush_keys:
+            invalidator.invalidate_keys(obj_keys, flush_keys)
+
+
+class DeferredInvalidation(threading.local):
+    """
+    Invalidations held back until the transaction they were made in commits,
+    or until the end of a bulk operation (see ``collect``).
+
+    Keys are queued per database connection and deduplicated, then expanded
+    and deleted in one go from ``transaction.on_commit``.  Nothing happens if
+    the transaction is rolled back.
+    """
+
+    def __init__(self):
+        self.pending = {}
+        self.batch = None
+
+    def active(self, using):
+        """Whether invalidations for ``using`` would be deferred right now."""
+        if self.batch is not None:
+            return True
+        if not config.INVALIDATE_ON_COMMIT or using is None:
+            return False
+        if not hasattr(transaction, "on_commit"):
+            return False
+        return connections[using].in_atomic_block
+
+    @contextlib.contextmanager
+    def collect(self, using):
+        """
+        Gather the invalidations made inside the block, including those sent
+        by signals, into a single batch run when it exits.
+        """
+        if self.batch is not None:
+            # Part of an outer batch.
+            yield
+            return
+        batch = self.batch = Batch()
+        try:
+            yield
+        finally:
+            self.batch = None
+            # Even on errors: invalidating too much is harmless.
+            self.submit(using, batch)
+
+    def saturated(self, using, model, rows=0):
+        """
+        Whether ``model`` would be invalidated as a whole, once ``rows`` more
+        rows are queued for ``using``: there is no point collecting their keys
+        then.
+        """
+        limit = config.BULK_INVALIDATE_MAX_ROWS
+        if limit is None or not hasattr(model, "model_flush_key"):
+            return False
+        if self.batch is not None:
+            batch = self.batch
+        elif self.active(using):
+            batch = self.pending.get(using)
+        else:
+            batch = None
+        queued = batch.rows[model] if batch is not None else 0
+        return queued + rows > limit
+
+    def add(self, using, model, obj_keys, flush_keys, rows=1):
+        batch = Batch()
+        batch.add(model, obj_keys, flush_keys, rows)
+        self.submit(using, batch)
+
+    def submit(self, using, batch):
+        if self.batch is not None:
+            self.batch.update(batch)
+        elif self.active(using):
+            self.pending.setdefault(using, Batch()).update(batch)
+            # Callbacks go away with a rolled back savepoint, so register one
+            # for each change; the first to run does the work.  Keys left
+            # over by a rollback get invalidated with the next commit, which
+            # is harmless.
+            transaction.on_commit(lambda: self.run(using), using=using)
+        else:
+            batch.run()
+
+    def run(self, using):
+        batch = self.pending.pop(using, None)
+        if batch is not None:
+            logger.debug("invalidating on commit of %s" % using)
+            batch.run()
+
+
+deferred = DeferredInvalidation()
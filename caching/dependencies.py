@@ -0,0 +1,178 @@
+"""
+What cached queries depend on: the tables they read and, per model, the
+fields they select, filter, group or order on.
+"""
+from __future__ import unicode_literals
+
+import six
+from django.core.exceptions import FieldDoesNotExist
+from django.db import models
+from django.db.models import sql
+from django.db.models.expressions import Col, RawSQL
+from django.db.models.sql.where import ExtraWhere
+
+from caching.querykey import PLAIN_TYPES
+
+
+def label(model):
+    return "%s.%s" % (model._meta.app_label, model._meta.model_name)
+
+
+def walk(node, seen=None):
+    """Yield ``node`` and every query, expression and lookup found in it."""
+    if seen is None:
+        seen = set()
+    if node is None or isinstance(node, PLAIN_TYPES) or id(node) in seen:
+        return
+    seen.add(id(node))
+    if isinstance(node, models.QuerySet):
+        node = node.query
+    yield node
+    if isinstance(node, sql.Query):
+        children = [node.where] + list(node.annotations.values()) + list(node.select)
+        if isinstance(node.group_by, (list, tuple)):
+            children += list(node.group_by)
+        children += [o for o in node.order_by if not isinstance(o, six.string_types)]
+    elif isinstance(node, (list, tuple)):
+        children = node
+    else:
+        children = list(getattr(node, "children", ()))
+        children += [getattr(node, a, None) for a in ("lhs", "rhs", "query", "queryset")]
+        get_source_expressions = getattr(node, "get_source_expressions", None)
+        if callable(get_source_expressions):
+            children += get_source_expressions()
+    for child in children:
+        for found in walk(child, seen):
+            yield found
+
+
+def query_columns(query):
+    """
+    Return the {model label: field names} the results of ``query`` depend
+    on, with None for models it depends on as a whole, or None if that
+    can't be told (raw SQL, ``extra()``).
+    """
+    if not isinstance(query, sql.Query):
+        return None
+    columns = {}
+    for node in walk(query):
+        if isinstance(node, (ExtraWhere, RawSQL)):
+            return None
+        if isinstance(node, sql.Query):
+            if not _add_query(columns, node):
+                return None
+        elif isinstance(node, Col):
+            _add(columns, node.target.model, node.target.name)
+    return columns
+
+
+def changed_columns(model, fields):
+    """
+    Return the (model label, field name) pairs saving ``fields`` of a
+    ``model`` instance changes, or None if it may change which rows are
+    related to which (primary or foreign keys).
+    """
+    changed = set()
+    for name in fields:
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            return None
+        if field.primary_key or field.is_relation:
+            return None
+        changed.add((label(field.model), field.name))
+    return changed
+
+
+def depends(columns, changed):
+    """Whether a query on ``columns`` (see query_columns) sees ``changed``."""
+    if columns is None:
+        return True
+    for model, name in changed:
+        if model in columns and (columns[model] is None or name in columns[model]):
+            return True
+    return False
+
+
+def _add(columns, model, name=None):
+    names = columns.setdefault(label(model), set())
+    if name is None:
+        columns[label(model)] = None
+    elif names is not None:
+        names.add(name)
+
+
+def _add_query(columns, query):
+    model = query.model
+    if model is None:
+        return True
+    if query.extra or query.extra_tables or query.distinct_fields:
+        return False
+    if query.default_cols and not _add_loaded(columns, model, query.deferred_loading):
+        return False
+    if query.select_related:
+        _add_related(columns, model, query.select_related, 5)
+    ordering = query.order_by
+    if not ordering and query.default_ordering:
+        ordering = model._meta.ordering
+    for name in ordering:
+        if isinstance(name, six.string_types) and name != "?":
+            name = name.lstrip("-+")
+            if name not in query.annotations and not _add_path(columns, model, name):
+                return False
+    return True
+
+
+def _add_loaded(columns, model, deferred_loading):
+    names, defer = deferred_loading
+    if not names:
+        _add(columns, model)
+        return True
+    if any("__" in name for name in names):
+        return False
+    opts = model._meta
+    try:
+        fields = set(opts.get_field(name) for name in names)
+    except FieldDoesNotExist:
+        return False
+    if defer:
+        fields = set(opts.concrete_fields) - fields
+    for field in fields | set([opts.pk]):
+        _add(columns, field.model, field.name)
+    return True
+
+
+def _add_related(columns, model, related, depth):
+    # select_related=True follows the foreign keys that can't be null.
+    if related is True:
+        if not depth:
+            return
+        related = dict(
+            (f.name, True)
+            for f in model._meta.fields
+            if f.is_relation and not f.null
+        )
+    for name, nested in related.items():
+        related_model = model._meta.get_field(name).related_model
+        _add(columns, related_model)
+        _add_related(columns, related_model, nested or {}, depth - 1)
+
+
+def _add_path(columns, model, path):
+    opts = model._meta
+    for name in path.split("__"):
+        try:
+            field = opts.pk if name == "pk" else opts.get_field(name)
+        except FieldDoesNotExist:
+            return False
+        if not field.concrete:
+            # Reverse relation.
+            _add(columns, field.related_model)
+        else:
+            _add(columns, field.model, field.name)
+            if field.is_relation:
+                # Ordering by a relation orders by the related model's ordering.
+                _add(columns, field.related_model)
+        if field.is_relation:
+            opts = field.related_model._meta
+    return True
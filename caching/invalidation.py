@@ -5,15 +5,30 @@ import logging
 
 from caching import config
 from caching.compat import cache
-from caching.invalidators import NullInvalidator, RedisInvalidator, Invalidator
+from caching.invalidators import (
+    GenerationInvalidator,
+    Invalidator,
+    NullInvalidator,
+    RedisInvalidator,
+)
+from caching.local import LocalCache
 
 logger = logging.getLogger('caching.invalidation')
 
+local = None
+if config.LOCAL_CACHE_SIZE:
+    local = LocalCache(config.LOCAL_CACHE_SIZE, config.LOCAL_CACHE_TIMEOUT)
+
 
 if config.CACHE_MACHINE_NO_INVALIDATION:
     invalidator = NullInvalidator()
+elif config.CACHE_MACHINE_USE_GENERATIONS:
+    invalidator = GenerationInvalidator(cache=cache,
+                                        logger=logger,
+                                        local=local)
 elif config.CACHE_MACHINE_USE_REDIS:
     invalidator = RedisInvalidator(cache=cache,
-                                   logger=logger)
+                                   logger=logger,
+                                   local=local)
 else:
-    invalidator = Invalidator(cache=cache, logger=logger)
+    invalidator = Invalidator(cache=cache, logger=logger, local=local)
@@ -1,3 +1,4 @@
 from .base import Invalidator  # noqa
 from .redis import RedisInvalidator  # noqa
+from .generation import GenerationInvalidator  # noqa
 from .null import NullInvalidator  # noqa
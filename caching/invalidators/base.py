@@ -1,22 +1,287 @@
 import collections
+import contextlib
+import functools
+import math
+import os
+import threading
+import time
+import uuid
+import zlib
+from multiprocessing.pool import ThreadPool
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
 
 from caching import config
-from caching.utils import byid
+from caching.codec import DEFAULT_MIN_SIZE, Codec
+from caching.dependencies import changed_columns, depends
+from caching.predicates import matches
+from caching.local import LocalChannel, memo
+from caching.utils import byid, flush_key
+
+
+# Compare-and-set attempts on a flush list before giving up on it.
+CAS_ATTEMPTS = 5
+
+# Memcached clients whose gets returns a (value, token) pair for cas.
+CAS_LIBRARIES = ("pylibmc", "pymemcache")
+
+# Flush keys of querysets start with this, see CachingQuerySet.flush_key.
+QUERY_PREFIX = "qs:"
+
+# Thread pools running chunks of multi-gets and multi-sets, by process.
+_pools = {}
+
+
+def columns_key(query_flush):
+    """Key of the fields the query behind ``query_flush`` depends on."""
+    return "columns:%s" % query_flush
+
+
+def predicate_key(query_flush):
+    """Key of the filters of the query behind ``query_flush``."""
+    return "predicate:%s" % query_flush
+
+
+def queries_key(model):
+    """Key of the list of query flush keys of ``model``."""
+    return "%s:queries" % model.model_flush_key()
+
+
+def thread_map(function, items):
+    """``map`` on a pool of CACHE_MULTI_THREADS threads."""
+    pool = _pools.get(os.getpid())
+    if pool is None:
+        # Threads don't survive a fork, start a pool in every process.
+        pool = _pools[os.getpid()] = ThreadPool(config.MULTI_THREADS)
+    return pool.map(function, items)
+
+
+def thread_safe(cache):
+    """
+    Whether the client of the Django cache ``cache`` can be shared between
+    threads: django-redis' can, through redis-py's connection pool.
+    """
+    return callable(getattr(getattr(cache, "client", None), "get_client", None))
+
+
+def compact(flush_list, now):
+    """Return ``flush_list`` as an {entry: expiry} dict, without dead entries."""
+    if flush_list is None:
+        return {}
+    if not isinstance(flush_list, dict):
+        # Written by an older version.
+        return dict.fromkeys(flush_list)
+    return dict((k, e) for k, e in flush_list.items() if e is None or e > now)
+
+
+def merge(flush_list, entries, expiry, now):
+    """Return ``flush_list``, compacted, with ``entries`` kept until ``expiry``."""
+    flush_list = compact(flush_list, now)
+    for entry in entries:
+        flush_list[entry] = later(flush_list.get(entry, 0), expiry)
+    return flush_list
+
+
+def later(a, b):
+    """The later of two expiries, None being never."""
+    if a is None or b is None:
+        return None
+    return max(a, b)
+
+
+def list_timeout(flush_list, now):
+    """The timeout for a flush list to expire with its last entry."""
+    expiry = functools.reduce(later, flush_list.values(), 0)
+    if expiry is None:
+        return DEFAULT_TIMEOUT
+    return max(1, int(math.ceil(expiry - now)))
+
+
+class FillState(threading.local):
+    """The cache fill in progress in this thread, see ``Invalidator.fill``."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.stats = None
+        # Writes queued by invalidators that batch them, and what to do with
+        # their results.
+        self.pipe = None
+        self.callbacks = []
 
 
 class Invalidator(object):
+
+    # Optional process-local cache (caching.local.LocalCache) in front of
+    # the backend, kept coherent through ``channel``.
+    local = None
+
+    # Compresses big values on their way to the backend.
+    codec = Codec()
+
+    # Number of cache fills, and the round trips and bytes they took.
+    fill_stats = collections.Counter()
+    fills = FillState()
+
+    # Whether the cache backend's client can be used by several threads at
+    # once, see CACHE_MULTI_CONCURRENT.
+    concurrent = False
+
     def __init__(self, cache, logger, *args, **kwargs):
         self.cache = cache
         self.logger = logger
+        self.concurrent = config.MULTI_CONCURRENT
+        if self.concurrent is None:
+            self.concurrent = thread_safe(cache)
+        self.local = kwargs.get("local")
+        if self.local is not None:
+            self.channel = self.make_channel()
+            self.channel.subscribe(self.drop_local)
+            # Start hearing about invalidations before anything is cached.
+            self.channel.listen()
+
+    def make_channel(self):
+        """Return the channel used to broadcast invalidations to local caches."""
+        return LocalChannel()
+
+    def drop_local(self, keys):
+        """Drop ``keys`` from the local cache; None means drop everything."""
+        if keys is None:
+            self.local.clear()
+        else:
+            self.local.delete_many(keys)
+
+    def is_local(self, key):
+        # Flush lists are read-modify-written by every process, so they
+        # always come from the backend.
+        return config.FLUSH_PREFIX not in key
 
     def get(self, key):
-        return self.cache.get(self.make_key(key))
+        key = self.make_key(key)
+        if not self.is_local(key):
+            return self.cache_get(key)
+        value = memo.get(key)
+        if value is None:
+            value = self.fetch(key)
+            memo.set(key, value)
+        return value
+
+    def fetch(self, key):
+        """Read ``key`` from the local cache, falling back to the backend."""
+        if self.local is None or not self.channel.listen():
+            return self.cache_get(key)
+        value = self.local.get(key)
+        if value is None:
+            epoch = self.local.epoch
+            value = self.cache_get(key)
+            self.local.set(key, value, epoch)
+        return value
+
+    def store(self, key, value):
+        """Keep a value we just wrote to the backend in the local tiers."""
+        if self.is_local(key):
+            memo.set(key, value)
+            if self.local is not None:
+                self.local.set(key, value)
+
+    @contextlib.contextmanager
+    def fill(self):
+        """
+        Group the writes of one cache fill: the result, its flush lists and
+        any byid objects.  Fills nested in another one are part of it.
+        """
+        if self.fills.stats is not None:
+            yield
+            return
+        stats = self.fills.stats = collections.Counter()
+        try:
+            self.start_fill()
+            yield
+            self.finish_fill()
+        finally:
+            self.fills.reset()
+        self.fill_stats["fills"] += 1
+        self.fill_stats.update(stats)
+        self.logger.debug(
+            "cache fill: %d round trips, %d bytes" % (stats["round_trips"], stats["bytes"])
+        )
 
-    def add(self, key, objs, timeout=None):
-        return self.cache.add(self.make_key(key), objs, timeout=timeout)
+    def start_fill(self):
+        pass
+
+    def finish_fill(self):
+        pass
+
+    def count_trip(self, payloads=()):
+        """
+        Count a round trip made for the current fill, if any.  Only payloads
+        we serialized ourselves (bytes) can be counted.
+        """
+        stats = self.fills.stats
+        if stats is not None:
+            stats["round_trips"] += 1
+            stats["bytes"] += sum(len(p) for p in payloads if isinstance(p, bytes))
 
-    def set(self, key, value, duration):
-        self.cache.set(self.make_key(key), value, duration)
+    def cache_get(self, key):
+        return self.codec.decode(self.cache.get(key))
+
+    def cache_get_many(self, keys):
+        found = {}
+        for part in self.map_chunks(self.cache.get_many, self.chunks(list(keys))):
+            found.update(part)
+        return dict((k, self.codec.decode(v)) for k, v in found.items())
+
+    def chunks(self, items):
+        """Split ``items`` for multi-gets and multi-sets."""
+        size = config.MULTI_CHUNK_SIZE or len(items) or 1
+        return [items[i:i + size] for i in range(0, len(items), size)]
+
+    def map_chunks(self, function, chunks):
+        """
+        Return ``function`` called on each of ``chunks``, concurrently if the
+        cache backend's client allows it.
+        """
+        if len(chunks) > 1 and self.concurrent and config.MULTI_THREADS > 1:
+            return thread_map(function, chunks)
+        return [function(chunk) for chunk in chunks]
+
+    def add(self, key, objs, timeout=None, min_size=DEFAULT_MIN_SIZE):
+        """``min_size`` overrides CACHE_COMPRESS_MIN_SIZE for this value."""
+        key = self.make_key(key)
+        encoded = self.codec.encode(objs, min_size)
+        self.count_trip([encoded])
+        added = self.cache.add(key, encoded, timeout=timeout)
+        if added:
+            self.store(key, objs)
+        return added
+
+    def set(self, key, value, duration, min_size=DEFAULT_MIN_SIZE):
+        key = self.make_key(key)
+        encoded = self.codec.encode(value, min_size)
+        self.count_trip([encoded])
+        self.cache.set(key, encoded, duration)
+        self.store(key, value)
+
+    def lock(self, key, timeout):
+        """
+        Take the miss lock for ``key``, using the cache's atomic add.  Returns
+        the token to release it with, or None if someone else holds it.
+        """
+        token = uuid.uuid4().hex
+        if self.cache.add(self.make_key("lock:%s" % key), token, timeout):
+            return token
+        return None
+
+    def unlock(self, key, token):
+        """
+        Release the miss lock for ``key`` if we still hold it: once it has
+        timed out, it may have been taken by someone else.  There's no
+        compare-and-delete in memcached, so this is a get then a delete.
+        """
+        made = self.make_key("lock:%s" % key)
+        if self.cache.get(made) == token:
+            self.cache.delete(made)
 
     def make_key(self, key):
         if key.startswith(config.CACHE_PREFIX):
@@ -24,8 +289,38 @@ class Invalidator(object):
 
         return "{}{}".format(config.CACHE_PREFIX, key)
 
-    def invalidate_objects(self, objects, is_new_instance=False, model_cls=None):
+    def version_key(self, key, *deps):
+        """
+        Return the key to cache a value depending on ``deps`` (querysets or
+        objects) under.  Flush lists keep track of dependencies themselves,
+        so the key is left alone.
+        """
+        return key
+
+    def invalidate_objects(
+        self, objects, is_new_instance=False, model_cls=None, update_fields=None
+    ):
         """Invalidate all the flush lists for the given ``objects``."""
+        obj_keys, flush_keys = self.object_keys(
+            objects, is_new_instance, model_cls, update_fields
+        )
+        if not obj_keys and not flush_keys:
+            return
+        self.invalidate_keys(obj_keys, flush_keys)
+
+    def object_keys(
+        self, objects, is_new_instance=False, model_cls=None, update_fields=None
+    ):
+        """
+        Return the (object keys, flush keys) to invalidate for ``objects``.
+
+        With CACHE_FIELD_INVALIDATION, saving ``update_fields`` only reaches
+        the queries depending on one of them.
+        """
+        if config.FIELD_INVALIDATION and update_fields and objects:
+            changed = changed_columns(type(objects[0]), update_fields)
+            if changed is not None:
+                return self.field_keys(objects, changed)
         obj_keys = [k for o in objects for k in o._cache_keys()]
         flush_keys = [k for o in objects for k in o._flush_keys()]
         # If whole-model invalidation on create is enabled, include this model's
@@ -38,31 +333,121 @@ class Invalidator(object):
             and hasattr(model_cls, "model_flush_key")
         ):
             flush_keys.append(model_cls.model_flush_key())
-        if not obj_keys or not flush_keys:
-            return
-        obj_keys, flush_keys = self.expand_flush_lists(obj_keys, flush_keys)
+        elif (
+            config.CACHE_INVALIDATE_ON_CREATE == config.MATCHING
+            and is_new_instance
+            and model_cls
+            and hasattr(model_cls, "model_flush_key")
+        ):
+            flush_keys.extend(self.matching_keys(model_cls, objects))
+        return obj_keys, flush_keys
+
+    def matching_keys(self, model, objects):
+        """
+        Return the flush keys of the queries on ``model`` that new
+        ``objects`` may belong in: those whose filters one of them may
+        satisfy, or whose filters aren't known.
+        """
+        queries = list(self.get_flush_lists([queries_key(model)]))
+        found = self.get_many(list(map(predicate_key, queries)))
+        flush_keys = []
+        for query_flush in queries:
+            predicate = found.get(predicate_key(query_flush))
+            if predicate is None or any(
+                matches(predicate, obj) is not False for obj in objects
+            ):
+                flush_keys.append(query_flush)
+        self.logger.debug(
+            "%d of %d queries match new objects" % (len(flush_keys), len(queries))
+        )
+        return flush_keys
+
+    def field_keys(self, objects, changed):
+        """
+        Return the keys of ``objects`` and the query flush lists found in
+        their flush lists whose query depends on a ``changed`` field.
+        """
+        obj_keys = set(k for o in objects for k in o._cache_keys())
+        search = seen = set(k for o in objects for k in o._flush_keys())
+        queries = set()
+        while search:
+            new_keys = set()
+            for key in self.get_flush_lists(search):
+                if config.FLUSH_PREFIX not in key:
+                    obj_keys.add(key)
+                elif key.startswith(QUERY_PREFIX):
+                    queries.add(key)
+                elif key not in seen:
+                    new_keys.add(key)
+            seen.update(new_keys)
+            search = new_keys
+        queries = list(queries)
+        found = self.get_many(list(map(columns_key, queries)))
+        flush_keys = [q for q in queries if depends(found.get(columns_key(q)), changed)]
+        self.logger.debug(
+            "%d of %d queries depend on %s" % (len(flush_keys), len(queries), changed)
+        )
+        return obj_keys, flush_keys
+
+    def model_keys(self, model):
+        """Return the flush keys invalidating ``model`` as a whole."""
+        if config.CACHE_INVALIDATE_ON_CREATE == config.MATCHING:
+            return [model.model_flush_key(), queries_key(model)]
+        return [model.model_flush_key()]
+
+    def invalidate_keys(self, obj_keys, flush_keys):
+        """
+        Delete ``obj_keys``, the ``flush_keys`` lists and everything found in
+        them, recursively.
+        """
+        if flush_keys:
+            obj_keys, flush_keys = self.expand_flush_lists(obj_keys, flush_keys)
         if obj_keys:
             self.logger.debug("deleting object keys: %s" % obj_keys)
-            self.cache.delete_many(map(self.make_key, obj_keys))
+            obj_keys = list(map(self.make_key, obj_keys))
+            self.cache.delete_many(obj_keys)
+            self.forget(obj_keys)
         if flush_keys:
             self.logger.debug("clearing flush lists: %s" % flush_keys)
             self.clear_flush_lists(flush_keys)
 
-    def cache_objects(self, model, objects, query_key, query_flush):
+    def forget(self, keys):
+        """Drop deleted ``keys`` from the request memo and the local caches."""
+        memo.delete_many(keys)
+        if self.local is not None:
+            self.channel.publish(keys)
+
+    def cache_objects(
+        self,
+        model,
+        objects,
+        query_key,
+        query_flush,
+        chunk_keys=(),
+        columns=None,
+        predicate=None,
+        timeout=DEFAULT_TIMEOUT,
+    ):
         # Add this query to the flush list of each object.  We include
         # query_flush so that other things can be cached against the queryset
-        # and still participate in invalidation.
+        # and still participate in invalidation.  The chunks of a chunked
+        # result go with their manifest, so they're flushed together.
+        query_keys = [query_key] + list(chunk_keys)
         flush_keys = [o.flush_key() for o in objects]
 
         flush_lists = collections.defaultdict(set)
         for key in flush_keys:
             self.logger.debug("adding %s to %s" % (query_flush, key))
             flush_lists[key].add(query_flush)
-        flush_lists[query_flush].add(query_key)
+        flush_lists[query_flush].update(query_keys)
         # Add this query to the flush key for the entire model, if enabled
         model_flush = model.model_flush_key()
-        if config.CACHE_INVALIDATE_ON_CREATE == config.WHOLE_MODEL:
-            flush_lists[model_flush].add(query_key)
+        if self.model_lists():
+            flush_lists[model_flush].update(query_keys)
+            if config.FETCH_BY_ID:
+                flush_lists[model_flush].update(byid(o) for o in objects)
+        if config.CACHE_INVALIDATE_ON_CREATE == config.MATCHING:
+            flush_lists[queries_key(model)].add(query_flush)
         # Add each object to the flush lists of its foreign keys.
         for obj in objects:
             obj_flush = obj.flush_key()
@@ -72,7 +457,38 @@ class Invalidator(object):
                     flush_lists[key].add(obj_flush)
                 if config.FETCH_BY_ID:
                     flush_lists[key].add(byid(obj))
-        self.add_to_flush_list(flush_lists)
+        self.add_to_flush_list(flush_lists, timeout, model)
+        if columns is not None:
+            # For field-aware invalidation, see ``field_keys``.
+            self.set(columns_key(query_flush), columns, DEFAULT_TIMEOUT)
+        if predicate is not None:
+            # For matching invalidation on create, see ``matching_keys``.
+            self.set(predicate_key(query_flush), predicate, DEFAULT_TIMEOUT)
+
+    def cache_object_keys(self, objects, timeout=DEFAULT_TIMEOUT):
+        """
+        Register values cached for single objects, a {key: object} dict, so
+        they're invalidated along with their object.
+        """
+        flush_lists = collections.defaultdict(set)
+        for key, obj in objects.items():
+            flush_lists[flush_key(obj)].add(key)
+            if self.model_lists():
+                flush_lists[obj.model_flush_key()].add(key)
+        if flush_lists:
+            model = type(next(iter(objects.values())))
+            self.add_to_flush_list(flush_lists, timeout, model)
+
+    def model_lists(self):
+        """
+        Whether cached values go on their model's flush list too, for
+        invalidating the whole model.
+        """
+        return (
+            config.CACHE_INVALIDATE_ON_CREATE == config.WHOLE_MODEL
+            or config.BULK_INVALIDATE_MAX_ROWS is not None
+            or config.FLUSH_LIST_MAX_SIZE is not None
+        )
 
     def expand_flush_lists(self, obj_keys, flush_keys):
         """
@@ -101,22 +517,206 @@ class Invalidator(object):
             flush_keys.update(new_keys)
             search_keys = new_keys
 
-    def add_to_flush_list(self, mapping):
-        """Update flush lists with the {flush_key: [query_key,...]} map."""
-        flush_lists = collections.defaultdict(set)
-        flush_lists.update(self.get_many(list(mapping.keys())))
+    def add_to_flush_list(self, mapping, timeout=DEFAULT_TIMEOUT, model=None):
+        """
+        Update flush lists with the {flush_key: [query_key,...]} map.
+
+        Lists are {entry: expiry} dicts: entries are kept for ``timeout``,
+        that of what they point to, dead ones are dropped whenever a list is
+        written, and lists expire with their last entry.  Lists growing past
+        CACHE_FLUSH_LIST_MAX_SIZE are invalidated, along with ``model`` as a
+        whole, and start over.
+
+        With CACHE_FLUSH_LIST_SHARDS, each list is spread over that many
+        keys, entries going to a shard by hash.  With CACHE_FLUSH_LIST_CAS,
+        shards are updated with compare-and-set rather than overwritten.
+        Lists we can't get our entries into that way are invalidated, along
+        with ``model`` and the entries themselves.
+        """
+        now = time.time()
+        expiry = self.expiry(timeout, now)
+        shards, lists = collections.defaultdict(set), {}
         for key, list_ in list(mapping.items()):
-            if flush_lists[key] is None:
-                flush_lists[key] = set(list_)
+            for entry in list_:
+                shard = self.shard_key(key, entry)
+                shards[shard].add(entry)
+                lists[shard] = key
+        max_size = config.FLUSH_LIST_MAX_SIZE
+        if max_size is not None:
+            max_size = int(math.ceil(max_size / float(config.FLUSH_LIST_SHARDS)))
+        client = self.cas_client()
+        lost = []
+        if client is not None:
+            overflow = []
+            for shard, entries in shards.items():
+                written = self.cas_add(client, shard, entries, expiry, now, max_size)
+                if written is None:
+                    lost.append(shard)
+                elif not written:
+                    overflow.append(shard)
+            flush_lists = {}
+        else:
+            self.count_trip()
+            found = self.get_many(list(shards.keys()))
+            flush_lists, overflow = {}, []
+            for shard, entries in shards.items():
+                flush_list = flush_lists[shard] = merge(found.get(shard), entries, expiry, now)
+                if max_size is not None and len(flush_list) > max_size:
+                    overflow.append(shard)
+        if overflow:
+            reset = set(lists[shard] for shard in overflow)
+            if model is not None:
+                reset.update(self.model_keys(model))
+            self.logger.warning("flush lists too long, invalidating %s" % reset)
+            self.invalidate_keys([], reset)
+            for shard, key in lists.items():
+                if key in reset:
+                    flush_lists[shard] = dict.fromkeys(shards[shard], expiry)
+        by_timeout = collections.defaultdict(dict)
+        for key, flush_list in flush_lists.items():
+            by_timeout[list_timeout(flush_list, now)][key] = flush_list
+        for list_timeout_, values in by_timeout.items():
+            self.set_many(values, list_timeout_)
+        if lost:
+            self.invalidate_lost(dict((lists[s], shards[s]) for s in lost), model)
+
+    def invalidate_lost(self, mapping, model=None):
+        """
+        Invalidate the flush lists of the {flush_key: entries} map, which we
+        couldn't add the entries to, along with ``model`` and the entries:
+        what they point to would otherwise never get invalidated.
+        """
+        obj_keys, flush_keys = set(), set(mapping)
+        for entries in mapping.values():
+            for entry in entries:
+                if config.FLUSH_PREFIX in entry:
+                    flush_keys.add(entry)
+                else:
+                    obj_keys.add(entry)
+        if model is not None:
+            flush_keys.update(self.model_keys(model))
+        self.logger.warning("lost flush list entries, invalidating %s" % flush_keys)
+        self.invalidate_keys(obj_keys, flush_keys)
+
+    def shard_key(self, key, entry):
+        """The key of the shard of flush list ``key`` holding ``entry``."""
+        if config.FLUSH_LIST_SHARDS <= 1:
+            return key
+        digest = zlib.crc32(entry.encode("utf-8")) & 0xFFFFFFFF
+        return "%s:%d" % (key, digest % config.FLUSH_LIST_SHARDS)
+
+    def shard_keys(self, keys):
+        """All the keys flush lists ``keys`` are stored under."""
+        if config.FLUSH_LIST_SHARDS <= 1:
+            return list(keys)
+        return [
+            "%s:%d" % (key, i) for key in keys for i in range(config.FLUSH_LIST_SHARDS)
+        ]
+
+    def cas_client(self):
+        """
+        The backend's memcached client with CACHE_FLUSH_LIST_CAS, if it does
+        compare-and-set the way pylibmc and pymemcache do.
+        """
+        if not config.FLUSH_LIST_CAS:
+            return None
+        client = getattr(self.cache, "_cache", None)
+        # python-memcached has gets and cas too, but its gets only returns the
+        # value, keeping the token on the client.
+        library = type(client).__module__.split(".")[0]
+        if library not in CAS_LIBRARIES:
+            return None
+        return client
+
+    def cas_add(self, client, key, entries, expiry, now, max_size=None):
+        """
+        Add ``entries`` to the flush list ``key`` with gets and cas, retrying
+        when someone else wrote it in between.  Returns False, writing
+        nothing, if the list would get longer than ``max_size``, and None if
+        it was written by others every one of CAS_ATTEMPTS times.
+        """
+        made = self.cache.make_key(self.make_key(key))
+        for attempt in range(CAS_ATTEMPTS):
+            self.count_trip()
+            value, token = client.gets(made)
+            flush_list = merge(
+                None if value is None else self.codec.decode(value), entries, expiry, now
+            )
+            if max_size is not None and len(flush_list) > max_size:
+                return False
+            encoded = self.codec.encode(flush_list)
+            timeout = self.cache.get_backend_timeout(list_timeout(flush_list, now))
+            self.count_trip([encoded])
+            if token is None:
+                written = client.add(made, encoded, timeout)
             else:
-                flush_lists[key].update(list_)
-        self.set_many(flush_lists)
+                written = client.cas(made, encoded, token, timeout)
+            if written:
+                return True
+        # Overwriting the list could drop what others just added to it.
+        self.logger.warning("gave up on compare-and-set of %s" % key)
+        return None
+
+    def expiry(self, timeout, now):
+        """When something cached for ``timeout`` from ``now`` expires."""
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = getattr(self.cache, "default_timeout", None)
+        if not timeout or timeout < 0:
+            # Forever, with Cache Machine's backends.
+            return None
+        return now + timeout
+
+    def set_many(self, values, timeout=DEFAULT_TIMEOUT, min_size=DEFAULT_MIN_SIZE):
+        values = dict((self.make_key(k), v) for k, v in values.items())
+        encoded = dict((k, self.codec.encode(v, min_size)) for k, v in values.items())
+
+        def set_chunk(items):
+            return self.cache.set_many(dict(items), timeout=timeout)
 
-    def set_many(self, values):
-        self.cache.set_many(map(self.make_key, values))
+        chunks = self.chunks(list(encoded.items()))
+        for chunk in chunks:
+            self.count_trip([v for k, v in chunk])
+        self.map_chunks(set_chunk, chunks)
+        for key, value in values.items():
+            self.store(key, value)
 
     def get_many(self, keys):
-        self.cache.get_many(map(self.make_key, keys()))
+        """Return a {key: value} dict of the ``keys`` found in the cache."""
+        made = dict((self.make_key(k), k) for k in keys)
+        found, missed = {}, []
+        for key in made:
+            value = memo.get(key) if self.is_local(key) else None
+            if value is None:
+                missed.append(key)
+            else:
+                found[key] = value
+        if missed:
+            fetched = self.fetch_many(missed)
+            for key, value in fetched.items():
+                if self.is_local(key):
+                    memo.set(key, value)
+            found.update(fetched)
+        return dict((made[k], v) for k, v in found.items())
+
+    def fetch_many(self, keys):
+        """Like ``fetch``, for several keys at once."""
+        if self.local is None or not self.channel.listen():
+            return self.cache_get_many(keys)
+        found, missed = {}, []
+        for key in keys:
+            value = self.local.get(key) if self.is_local(key) else None
+            if value is None:
+                missed.append(key)
+            else:
+                found[key] = value
+        if missed:
+            epoch = self.local.epoch
+            fetched = self.cache_get_many(missed)
+            for key, value in fetched.items():
+                if self.is_local(key):
+                    self.local.set(key, value, epoch)
+            found.update(fetched)
+        return found
 
     def get_flush_lists(self, keys):
         """Return a set of object keys from the lists in `keys`."""
@@ -124,7 +724,14 @@ class Invalidator(object):
             e
             for flush_list in [
                 _f
-                for _f in list(self.cache.get_many(map(self.make_key, keys)).values())
+                for _f in map(
+                    self.codec.decode,
+                    list(
+                        self.cache.get_many(
+                            list(map(self.make_key, self.shard_keys(keys)))
+                        ).values()
+                    ),
+                )
                 if _f
             ]
             for e in flush_list
@@ -132,4 +739,4 @@ class Invalidator(object):
 
     def clear_flush_lists(self, keys):
         """Remove the given keys from the database."""
-        self.cache.delete_many(map(self.make_key, keys))
+        self.cache.delete_many(list(map(self.make_key, self.shard_keys(keys))))
@@ -0,0 +1,195 @@
+from __future__ import unicode_literals
+
+import random
+
+from django.apps import apps
+from django.conf import settings
+from django.db import models
+from django.db.models import sql
+
+from caching.dependencies import walk
+from caching.querykey import PLAIN_TYPES
+from caching.utils import byid, flush_key, make_key
+
+from .base import Invalidator
+
+_tables = {}
+
+
+def table_model(table):
+    """Return the model stored in ``table``, if any."""
+    if not _tables:
+        for model in apps.get_models(include_auto_created=True):
+            _tables.setdefault(model._meta.db_table, model)
+    return _tables.get(table)
+
+
+def query_models(query):
+    """Return the models whose tables ``query`` reads, subqueries included."""
+    tables = set()
+    for node in walk(query):
+        if isinstance(node, sql.Query):
+            # Aliases are only set up once a query filters or is compiled.
+            if node.model is not None:
+                tables.add(node.model._meta.db_table)
+            tables.update(t.table_name for t in node.alias_map.values())
+            tables.update(node.extra_tables)
+            # select_related() joins are only set up at compile time.
+            if node.model is not None and node.select_related:
+                _add_related(tables, node.model, node.select_related, node.max_depth)
+    return set(m for m in map(table_model, tables) if m is not None)
+
+
+def _add_related(tables, model, related, depth):
+    # select_related=True follows the foreign keys that can't be null.
+    if related is True:
+        if not depth:
+            return
+        related = dict(
+            (f.name, True)
+            for f in model._meta.fields
+            if f.is_relation and not f.null
+        )
+    for name, nested in related.items():
+        related_model = model._meta.get_field(name).related_model
+        tables.add(related_model._meta.db_table)
+        _add_related(tables, related_model, nested or {}, depth - 1)
+
+
+def pk_lookup(query):
+    """Return the primary key ``query`` looks up, if that's all it does."""
+    if (
+        len(query.alias_map) > 1
+        or query.extra_tables
+        or query.annotations
+        or query.select_related
+    ):
+        return None
+    where = query.where
+    if where.negated or len(where.children) != 1:
+        return None
+    lookup = where.children[0]
+    if getattr(lookup, "lookup_name", None) != "exact":
+        return None
+    if getattr(lookup.lhs, "target", None) != query.model._meta.pk:
+        return None
+    if not isinstance(lookup.rhs, PLAIN_TYPES) or lookup.rhs is None:
+        return None
+    return lookup.rhs
+
+
+class GenerationInvalidator(Invalidator):
+    """
+    Invalidate by bumping generation numbers rather than with flush lists.
+
+    Cache keys embed the generations of what they depend on: each model
+    whose table a query reads or, for primary key lookups and values cached
+    with an object, the object itself.  Saving an object bumps the
+    generations of its model, of itself and of the objects it points to, so
+    keys built with the old numbers are never read again and just expire.
+
+    Filling the cache writes nothing but the value, and invalidating doesn't
+    walk anything; reads take one more ``get_many`` for the generations.
+    """
+
+    def version_key(self, key, *deps):
+        names = []
+        for dep in deps:
+            names.extend(self.dependencies(dep))
+        if not names:
+            return key
+        gens = self.generations(names)
+        return "%s:%s" % (key, make_key(":".join(map(str, gens)), with_locale=False))
+
+    def dependencies(self, dep):
+        """Return the generation names ``dep`` (queryset or object) depends on."""
+        if isinstance(dep, models.Model):
+            return self.object_generations(type(dep), dep.pk)
+        query = getattr(dep, "query", None)
+        if isinstance(query, sql.Query):
+            pk = pk_lookup(query)
+            if pk is not None:
+                return self.object_generations(query.model, pk)
+            return [
+                m.model_flush_key()
+                for m in query_models(query)
+                if hasattr(m, "model_flush_key")
+            ]
+        # Raw SQL: all we know is the model.
+        model = getattr(dep, "model", None)
+        if hasattr(model, "model_flush_key"):
+            return [model.model_flush_key()]
+        return []
+
+    def object_generations(self, model, pk):
+        if not hasattr(model, "_cache_key"):
+            return []
+        return [self.epoch_key(model), flush_key(model._cache_key(pk))]
+
+    def epoch_key(self, model):
+        # Bumped when the model is invalidated as a whole, which has to reach
+        # keys depending on single objects too.
+        return "%s:epoch" % model.model_flush_key()
+
+    def model_keys(self, model):
+        return [model.model_flush_key(), self.epoch_key(model)]
+
+    def generation_key(self, name):
+        return self.make_key("gen:%s" % name)
+
+    def generations(self, names):
+        """Read the current generations of ``names`` in one round trip."""
+        keys = [self.generation_key(n) for n in names]
+        found = self.cache.get_many(keys)
+        for key in keys:
+            if found.get(key) is None:
+                found[key] = self.start(key)
+        return [found[k] for k in keys]
+
+    def start(self, key):
+        # Start from a random number rather than 0, so a generation that was
+        # evicted can't come back to a value keys were built with before.
+        self.cache.add(key, random.getrandbits(48), None)
+        return self.cache.get(key)
+
+    def bump(self, name):
+        key = self.generation_key(name)
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            self.start(key)
+
+    def object_keys(
+        self, objects, is_new_instance=False, model_cls=None, update_fields=None
+    ):
+        """
+        Return the (object keys, generations) to invalidate for ``objects``.
+
+        Object keys are deleted: there's nothing to version byid entries
+        with, so they go for every database (they don't depend on the locale).
+        """
+        obj_keys, gens = [], set()
+        for obj in objects:
+            obj_keys.extend(obj._cache_keys())
+            # Cached by FETCH_BY_ID, object lookups and in_bulk().
+            obj_keys.extend(
+                byid(obj._cache_key(obj.pk, db)) for db in settings.DATABASES
+            )
+            gens.update(obj._flush_keys())
+            gens.add(type(obj).model_flush_key())
+        return obj_keys, list(gens)
+
+    def invalidate_keys(self, obj_keys, flush_keys):
+        if obj_keys:
+            obj_keys = list(map(self.make_key, obj_keys))
+            self.cache.delete_many(obj_keys)
+            self.forget(obj_keys)
+        for name in set(flush_keys):
+            self.bump(name)
+
+    def cache_objects(self, *args, **kwargs):
+        # Nothing to track: the query key already says what it depends on.
+        pass
+
+    def add_to_flush_list(self, mapping, *args, **kwargs):
+        pass
@@ -5,5 +5,5 @@ class NullInvalidator(Invalidator):
     def __init__(self, *args, **kwargs):
         pass
 
-    def add_to_flush_list(self, mapping):
+    def add_to_flush_list(self, mapping, *args, **kwargs):
         return
@@ -1,5 +1,93 @@
+import uuid
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+
+from caching import config
+from caching.codec import DEFAULT_MIN_SIZE
+from caching.local import RedisChannel
+
 from .base import Invalidator
 
+# Expand the flush lists in KEYS breadth-first, then delete the object and
+# query keys found along with the lists visited, in one atomic call.
+#
+# ARGV: CACHE_PREFIX, FLUSH_PREFIX, the maximum number of lists to visit, what
+# the cache backend puts before and after our keys, then the object keys to
+# delete.  Returns the object keys deleted and the lists left unvisited.
+FLUSH_SCRIPT = """
+local prefix, flush, limit = ARGV[1], ARGV[2], tonumber(ARGV[3])
+local left, right = ARGV[4], ARGV[5]
+
+local function made(key)
+  if string.sub(key, 1, #prefix) == prefix then
+    return key
+  end
+  return prefix .. key
+end
+
+local objects, found = {}, {}
+local function add_object(key)
+  key = made(key)
+  if not found[key] then
+    found[key] = true
+    objects[#objects + 1] = key
+  end
+end
+for i = 6, #ARGV do
+  add_object(ARGV[i])
+end
+
+local queue, seen, visited, head = {}, {}, {}, 1
+for _, key in ipairs(KEYS) do
+  if not seen[key] then
+    seen[key] = true
+    queue[#queue + 1] = key
+  end
+end
+while head <= #queue and #visited < limit do
+  local key = queue[head]
+  head = head + 1
+  visited[#visited + 1] = key
+  for _, member in ipairs(redis.call("SMEMBERS", key)) do
+    if string.find(member, flush, 1, true) then
+      member = made(member)
+      if not seen[member] then
+        seen[member] = true
+        queue[#queue + 1] = member
+      end
+    else
+      add_object(member)
+    end
+  end
+end
+
+local function delete(keys, wrap)
+  for i = 1, #keys, 1000 do
+    local batch = {}
+    for j = i, math.min(i + 999, #keys) do
+      batch[#batch + 1] = wrap and (left .. keys[j] .. right) or keys[j]
+    end
+    redis.call("DEL", unpack(batch))
+  end
+end
+delete(objects, true)
+delete(visited, false)
+
+local rest = {}
+for i = head, #queue do
+  rest[#rest + 1] = queue[i]
+end
+return {objects, rest}
+"""
+
+# Delete the lock in KEYS[1] if it still holds the token in ARGV[1].
+UNLOCK_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+  return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
 
 def get_redis_client(cache):
     client = getattr(cache, "_client", getattr(cache, "master_client", None))
@@ -26,6 +114,46 @@ class RedisInvalidator(Invalidator):
             )
 
         super(RedisInvalidator, self).__init__(cache, *args, **kwargs)
+        self.flush_script = self.client.register_script(FLUSH_SCRIPT)
+        self.unlock_script = self.client.register_script(UNLOCK_SCRIPT)
+        # django-redis' own serializer, to write values it can read back.
+        self.encode = getattr(getattr(cache, "client", None), "encode", None)
+        self.key_template = self.get_key_template()
+
+    def get_key_template(self):
+        """
+        Return what the cache backend puts (before, after) our keys, so the
+        flush script can delete cached values; or None if the backend mangles
+        keys some other way, or keeps values outside of our Redis.
+        """
+        if not self.shares_values():
+            return None
+        marker = "cache-machine-key"
+        key = "%s" % self.cache.make_key(marker)
+        if key.count(marker) != 1:
+            return None
+        return tuple(key.split(marker))
+
+    def shares_values(self):
+        """
+        Whether cached values live in the Redis holding the flush lists: the
+        cache backend is django-redis, talking to the same server.
+        """
+        get_client = getattr(getattr(self.cache, "client", None), "get_client", None)
+        if self.encode is None or not callable(get_client):
+            return False
+        client = get_client(write=True)
+        if client is self.client:
+            return True
+        pools = [getattr(c, "connection_pool", None) for c in (client, self.client)]
+        if None in pools:
+            return False
+        return pools[0] is pools[1] or (
+            pools[0].connection_kwargs == pools[1].connection_kwargs
+        )
+
+    def make_channel(self):
+        return RedisChannel(self.client, config.LOCAL_CACHE_CHANNEL)
 
     def safe_key(self, key):
         if " " in key or "\n" in key:
@@ -33,15 +161,114 @@ class RedisInvalidator(Invalidator):
             return ""
         return self.make_key(key)
 
-    def add_to_flush_list(self, mapping):
+    def lock(self, key, timeout):
+        key = self.safe_key("lock:%s" % key)
+        token = uuid.uuid4().hex
+        if self.client.set(key, token, nx=True, ex=max(int(timeout), 1)):
+            return token
+        return None
+
+    def unlock(self, key, token):
+        self.unlock_script(keys=[self.safe_key("lock:%s" % key)], args=[token])
+
+    def start_fill(self):
+        # Values are written with the backend's serializer, so we can only
+        # pipeline them with django-redis.
+        if config.REDIS_FILL_PIPELINE and self.encode is not None:
+            self.fills.pipe = self.client.pipeline(transaction=False)
+
+    def finish_fill(self):
+        pipe = self.fills.pipe
+        if pipe is None or not self.fills.callbacks:
+            return
+        self.count_trip()
+        results = pipe.execute()
+        for callback, result in zip(self.fills.callbacks, results):
+            if callback is not None:
+                callback(result)
+
+    def queue_set(self, key, value, timeout, min_size, nx=False):
+        """
+        Queue a write of ``value`` in the current fill's pipeline.  Returns
+        False if there's no pipeline to queue it in.
+        """
+        pipe = self.fills.pipe
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.cache.default_timeout
+        if pipe is None or (timeout is not None and timeout <= 0):
+            return False
+        key = self.make_key(key)
+        payload = self.encode(self.codec.encode(value, min_size))
+        if isinstance(payload, bytes):
+            self.fills.stats["bytes"] += len(payload)
+        px = None if timeout is None else int(timeout * 1000)
+        pipe.set(self.cache.make_key(key), payload, px=px, nx=nx)
+        self.fills.callbacks.append(lambda ok: ok and self.store(key, value))
+        return True
+
+    def add(self, key, objs, timeout=None, min_size=DEFAULT_MIN_SIZE):
+        """Within a pipelined fill, returns None: we don't know yet."""
+        if self.queue_set(key, objs, timeout, min_size, nx=True):
+            return None
+        return super(RedisInvalidator, self).add(key, objs, timeout, min_size)
+
+    def set(self, key, value, duration, min_size=DEFAULT_MIN_SIZE):
+        if not self.queue_set(key, value, duration, min_size):
+            super(RedisInvalidator, self).set(key, value, duration, min_size)
+
+    def set_many(self, values, timeout=DEFAULT_TIMEOUT, min_size=DEFAULT_MIN_SIZE):
+        if self.fills.pipe is None:
+            return super(RedisInvalidator, self).set_many(values, timeout, min_size)
+        for key, value in values.items():
+            if not self.queue_set(key, value, timeout, min_size):
+                super(RedisInvalidator, self).set(key, value, timeout, min_size)
+
+    def invalidate_keys(self, obj_keys, flush_keys):
+        """
+        With CACHE_REDIS_FLUSH_SCRIPT on, expand and delete everything in one
+        call to the flush script rather than a round trip per level.
+
+        Lists the script didn't get to within CACHE_REDIS_FLUSH_LIMIT are
+        expanded the usual way.  The script touches keys it wasn't given, so
+        it doesn't work on Redis Cluster.
+        """
+        if not config.REDIS_FLUSH_SCRIPT or self.key_template is None or not flush_keys:
+            return super(RedisInvalidator, self).invalidate_keys(obj_keys, flush_keys)
+        args = [config.CACHE_PREFIX, config.FLUSH_PREFIX, config.REDIS_FLUSH_LIMIT]
+        args.extend(self.key_template)
+        args.extend(map(self.make_key, obj_keys))
+        deleted, rest = self.flush_script(
+            keys=list(map(self.safe_key, flush_keys)), args=args
+        )
+        deleted = [k.decode("utf-8") for k in deleted]
+        self.logger.debug("deleted object keys: %s" % deleted)
+        self.forget(deleted)
+        if rest:
+            self.logger.warning(
+                "flush list limit reached, %d lists left to expand" % len(rest)
+            )
+            super(RedisInvalidator, self).invalidate_keys(
+                [], [k.decode("utf-8") for k in rest]
+            )
+
+    def add_to_flush_list(self, mapping, timeout=DEFAULT_TIMEOUT, model=None):
         """Update flush lists with the {flush_key: [query_key,...]} map."""
-        pipe = self.client.pipeline(transaction=False)
+        pipe = self.fills.pipe
+        if pipe is None:
+            pipe = self.client.pipeline(transaction=False)
+        members = []
         for key, list_ in list(mapping.items()):
             for query_key in list_:
                 # Redis happily accepts unicode, but returns byte strings,
                 # so manually encode and decode the keys on the flush list here
-                pipe.sadd(self.safe_key(key), query_key.encode("utf-8"))
-        pipe.execute()
+                members.append(query_key.encode("utf-8"))
+                pipe.sadd(self.safe_key(key), members[-1])
+        if pipe is self.fills.pipe:
+            self.fills.stats["bytes"] += sum(map(len, members))
+            self.fills.callbacks.extend([None] * len(members))
+        else:
+            self.count_trip(members)
+            pipe.execute()
 
     def get_flush_lists(self, keys):
         flush_list = self.client.sunion(list(map(self.safe_key, keys)))
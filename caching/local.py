@@ -0,0 +1,204 @@
+from __future__ import unicode_literals
+
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+from six.moves import cPickle as pickle
+
+logger = logging.getLogger("caching.local")
+
+
+class LocalCache(object):
+    """
+    A bounded, process-local LRU cache with a TTL, sitting in front of the
+    shared cache backend.
+
+    Values are kept pickled so every hit hands out fresh objects, just like a
+    hit on memcached or Redis would.  ``epoch`` is bumped on every delete so
+    a fill racing with an invalidation can be thrown away (see ``set``).
+    """
+
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self.data = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.epoch = 0
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.data.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+            # Re-insert to mark the key as most recently used.
+            self.data[key] = entry
+            self.hits += 1
+        return pickle.loads(entry[1])
+
+    def set(self, key, value, epoch=None):
+        """
+        Store ``value``, unless something was invalidated since ``epoch``.
+
+        Callers read ``epoch`` before fetching the value from the backend, so
+        a value that may predate an invalidation never makes it in here.
+        """
+        if value is None:
+            return
+        payload = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            if epoch is not None and epoch != self.epoch:
+                return
+            self.data.pop(key, None)
+            self.data[key] = (time.time() + self.timeout, payload)
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self.lock:
+            self.epoch += 1
+            for key in keys:
+                self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.epoch += 1
+            self.data.clear()
+
+
+class RequestMemo(threading.local):
+    """
+    Per-thread memo of cache lookups, open for the duration of a request.
+
+    Values are kept pickled, like in ``LocalCache``, so changes made to the
+    objects of one lookup don't show up in the next.  Use it through
+    ``RequestMemoMiddleware`` or as a context manager::
+
+        with memo:
+            ...
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.data = {}
+
+    def open(self):
+        self.depth += 1
+
+    def close(self):
+        self.depth = max(self.depth - 1, 0)
+        if not self.depth:
+            self.data.clear()
+
+    def reset(self):
+        self.depth = 0
+        self.data.clear()
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get(self, key):
+        if not self.depth:
+            return None
+        payload = self.data.get(key)
+        if payload is None:
+            return None
+        return pickle.loads(payload)
+
+    def set(self, key, value):
+        if self.depth and value is not None:
+            self.data[key] = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def delete_many(self, keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+
+memo = RequestMemo()
+
+
+class LocalChannel(object):
+    """
+    Invalidation broadcast for a single process.
+
+    Stand-in for ``RedisChannel`` when there's no shared bus: deletes only
+    reach this process, other processes rely on the local cache timeout.
+    """
+
+    def __init__(self):
+        self.callbacks = []
+
+    def subscribe(self, callback):
+        self.callbacks.append(callback)
+
+    def publish(self, keys):
+        for callback in self.callbacks:
+            callback(keys)
+
+    def listen(self):
+        """
+        Start receiving invalidations if needed.  Returns whether they're
+        being received, i.e. whether local copies can be trusted.
+        """
+        return True
+
+
+class RedisChannel(LocalChannel):
+    """Broadcast invalidated keys to every process over Redis pub/sub."""
+
+    retry_delay = 1
+
+    def __init__(self, client, name):
+        super(RedisChannel, self).__init__()
+        self.client = client
+        self.name = name
+        self.pid = None
+        # The process whose listener is subscribed, if any.
+        self.subscribed = None
+
+    def publish(self, keys):
+        # Drop our own copies right away, then tell everyone else.
+        super(RedisChannel, self).publish(keys)
+        self.client.publish(self.name, json.dumps(list(keys)))
+
+    def listen(self):
+        """
+        Start the listener thread, once per process (we may have forked).
+        Nothing published before it's subscribed reaches us, so local copies
+        can't be trusted until then.
+        """
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            thread = threading.Thread(target=self._listen, name="cache-machine-l1")
+            thread.daemon = True
+            thread.start()
+        return self.subscribed == self.pid
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.client.pubsub()
+                pubsub.subscribe(self.name)
+                for message in pubsub.listen():
+                    if message["type"] == "subscribe":
+                        # Drop whatever was cached before we could hear
+                        # about invalidations.
+                        LocalChannel.publish(self, None)
+                        self.subscribed = os.getpid()
+                    elif message["type"] == "message":
+                        LocalChannel.publish(self, json.loads(message["data"]))
+            except Exception:
+                logger.exception("lost the invalidation channel, retrying")
+            self.subscribed = None
+            # We may have missed invalidations while disconnected.
+            LocalChannel.publish(self, None)
+            time.sleep(self.retry_delay)
@@ -0,0 +1,28 @@
+from __future__ import unicode_literals
+
+try:
+    from django.utils.deprecation import MiddlewareMixin
+except ImportError:
+    # Old-style middleware only.
+    MiddlewareMixin = object
+
+from caching.local import memo
+
+
+class RequestMemoMiddleware(MiddlewareMixin):
+    """
+    Memoize cache lookups for the duration of each request.
+
+    Put it near the top of ``MIDDLEWARE`` so the memo covers everything that
+    runs below it, including template rendering.
+    """
+
+    def process_request(self, request):
+        # Start from a clean slate in case a previous request on this thread
+        # never made it to process_response.
+        memo.reset()
+        memo.open()
+
+    def process_response(self, request, response):
+        memo.reset()
+        return response
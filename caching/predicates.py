@@ -0,0 +1,156 @@
+"""
+Filters of cached queries, in a form new objects can be checked against.
+
+A predicate is either a lookup, ``(attname, lookup name, value)``, or a node,
+``(connector, negated, [children])``, mirroring Django's ``WhereNode``.  Checks
+answer True, False or None when Python can't tell how the database would
+compare the values (collations, NULLs, types), which counts as a match.
+"""
+from __future__ import unicode_literals
+
+import six
+
+from caching.querykey import PLAIN_TYPES, Col, Lookup, WhereNode
+
+STRING_LOOKUPS = {
+    "exact": lambda a, b: a == b,
+    "contains": lambda a, b: b in a,
+    "startswith": lambda a, b: a.startswith(b),
+    "endswith": lambda a, b: a.endswith(b),
+}
+
+ORDER_LOOKUPS = {
+    "gt": lambda a, b: a > b,
+    "gte": lambda a, b: a >= b,
+    "lt": lambda a, b: a < b,
+    "lte": lambda a, b: a <= b,
+    "range": lambda a, b: b[0] <= a <= b[1],
+}
+
+
+def query_predicate(query):
+    """
+    Return the predicate of ``query``'s filters, or None if they can't be
+    checked in Python: joins, expressions, ``extra()`` and so on.
+    """
+    if WhereNode is None or query.extra_tables:
+        return None
+    try:
+        return _node_predicate(query.where, query.model)
+    except ValueError:
+        return None
+
+
+def loads_instances(query):
+    """
+    Whether ``query`` loads whole model instances and nothing more: no
+    related objects, extra columns, deferred fields or offset.
+    """
+    return not (
+        query.select_related
+        or query.annotations
+        or query.extra
+        or query.deferred_loading[0]
+        or query.distinct_fields
+        or query.low_mark
+        or getattr(query, "combinator", None)
+    )
+
+
+def unique_lookup(query):
+    """
+    Return the (field, value) ``query`` looks one object up by, if that's all
+    it does: load a model instance whose primary key or a unique field is
+    exactly ``value``.  Returns None otherwise.
+    """
+    if not loads_instances(query) or query.high_mark == 0:
+        return None
+    predicate = query_predicate(query)
+    if predicate is None or predicate[1] or len(predicate[2]) != 1:
+        return None
+    attname, lookup, value = predicate[2][0]
+    if lookup != "exact" or value is None:
+        return None
+    field = query.model._meta.get_field(attname)
+    if not field.primary_key and (not field.unique or field.is_relation):
+        return None
+    return field, value
+
+
+def _node_predicate(node, model):
+    if isinstance(node, WhereNode):
+        children = [_node_predicate(child, model) for child in node.children]
+        return (node.connector, node.negated, children)
+    if not isinstance(node, Lookup) or type(node.lhs) is not Col:
+        raise ValueError(node)
+    field, rhs = node.lhs.target, node.rhs
+    if node.lhs.alias != model._meta.db_table:
+        # A column of another table.
+        raise ValueError(node)
+    if isinstance(rhs, (list, tuple, set, frozenset)):
+        if not all(isinstance(v, PLAIN_TYPES) for v in rhs):
+            raise ValueError(node)
+        rhs = tuple(rhs)
+    elif not isinstance(rhs, PLAIN_TYPES):
+        raise ValueError(node)
+    return (field.attname, node.lookup_name, rhs)
+
+
+def matches(predicate, obj):
+    """Whether ``obj`` may satisfy ``predicate``: True, False or None."""
+    if isinstance(predicate[2], list):
+        connector, negated, children = predicate
+        results = [matches(child, obj) for child in children]
+        if connector == "AND":
+            result = False if False in results else None if None in results else True
+        else:
+            result = True if True in results else None if None in results else False
+        if negated and result is not None:
+            result = not result
+        return result
+    attname, lookup, rhs = predicate
+    try:
+        field = obj._meta.get_field(attname)
+        value = field.to_python(getattr(obj, attname))
+        return _lookup(value, lookup, rhs)
+    except Exception:
+        return None
+
+
+def _lookup(value, lookup, rhs):
+    if lookup == "isnull":
+        return (value is None) == bool(rhs)
+    if value is None:
+        # NULL compares as unknown in SQL.
+        return None
+    if lookup == "in":
+        results = [_lookup(value, "exact", v) for v in rhs]
+        return True if True in results else None if None in results else False
+    if lookup.startswith("i") and lookup[1:] in STRING_LOOKUPS:
+        return _compare_strings(lookup[1:], value.lower(), rhs.lower())
+    if lookup in STRING_LOOKUPS:
+        if isinstance(value, six.string_types) or isinstance(rhs, six.string_types):
+            return _compare_strings(lookup, value, rhs)
+        if lookup != "exact":
+            return None
+        return value == rhs
+    if lookup in ORDER_LOOKUPS:
+        if isinstance(value, six.string_types):
+            # Depends on the collation.
+            return None
+        return ORDER_LOOKUPS[lookup](value, rhs)
+    return None
+
+
+def _compare_strings(lookup, value, rhs):
+    if not isinstance(value, six.string_types):
+        return None
+    try:
+        (value + rhs).encode("ascii")
+    except UnicodeError:
+        # Accents compare equal under some collations.
+        return None
+    result = STRING_LOOKUPS[lookup](value, rhs)
+    # Case and trailing spaces may not matter either.
+    loose = STRING_LOOKUPS[lookup](value.lower().rstrip(), rhs.lower().rstrip())
+    return result if result == loose else None
@@ -0,0 +1,178 @@
+from __future__ import unicode_literals
+
+import collections
+import datetime
+import decimal
+import hashlib
+import uuid
+
+import six
+
+from django.utils import encoding
+
+from caching import config
+
+try:
+    from django.db.models.expressions import Col
+    from django.db.models.lookups import Lookup
+    from django.db.models.sql.where import WhereNode
+except ImportError:
+    # Very old Django versions don't build lookups as objects; every query
+    # goes through the compiler.
+    Col = Lookup = WhereNode = None
+
+
+PLAIN_TYPES = six.string_types + six.integer_types + (
+    bytes,
+    float,
+    decimal.Decimal,
+    datetime.date,
+    datetime.time,
+    uuid.UUID,
+    type(None),
+)
+
+
+class Unshapeable(Exception):
+    """The query has a feature we can't describe without compiling it."""
+
+
+def _hashable(value):
+    if isinstance(value, dict):
+        return tuple(sorted((k, _hashable(v)) for k, v in value.items()))
+    return value
+
+
+def _where_shape(node, values):
+    if isinstance(node, WhereNode):
+        return (
+            node.connector,
+            node.negated,
+            tuple(_where_shape(child, values) for child in node.children),
+        )
+    if not isinstance(node, Lookup) or type(node.lhs) is not Col:
+        raise Unshapeable
+    rhs = node.rhs
+    if isinstance(rhs, (list, tuple)):
+        if not all(isinstance(v, PLAIN_TYPES) for v in rhs):
+            raise Unshapeable
+        values.append(tuple(rhs))
+        rhs_shape = len(rhs)
+    elif isinstance(rhs, PLAIN_TYPES):
+        values.append(rhs)
+        rhs_shape = None
+    else:
+        raise Unshapeable
+    return (type(node), node.lhs.alias, node.lhs.target, rhs_shape)
+
+
+def query_shape(query, using):
+    """
+    Split ``query`` into a (shape, values) pair without compiling it.
+
+    The shape describes everything that ends up in the SQL template and the
+    values are the filter parameters, so two queries that differ only by
+    their parameters share a shape.  Returns None for queries using anything
+    beyond plain column lookups on a single table (joins, annotations,
+    extra(), subqueries, expressions...); those have to be compiled.
+    """
+    if WhereNode is None:
+        return None
+    if (
+        query.annotations
+        or query.extra
+        or getattr(query, "extra_tables", ())
+        or getattr(query, "extra_order_by", ())
+        or getattr(query, "group_by", None) is not None
+        or getattr(query, "combinator", None)
+        or getattr(query, "distinct_fields", ())
+        or getattr(query, "select_for_update", False)
+        or getattr(query, "explain_query", False)
+        or getattr(query, "_filtered_relations", None)
+        or getattr(query, "subquery", False)
+        or query.select
+        or len(query.alias_map) > 1
+    ):
+        return None
+    if not all(isinstance(o, six.string_types) for o in query.order_by):
+        return None
+
+    values = []
+    try:
+        where = _where_shape(query.where, values)
+    except Unshapeable:
+        return None
+    values.extend([query.low_mark, query.high_mark])
+    shape = (
+        type(query),
+        query.model,
+        using,
+        where,
+        query.default_cols,
+        tuple(getattr(query, "values_select", ())),
+        query.distinct,
+        query.default_ordering,
+        query.standard_ordering,
+        tuple(query.order_by),
+        _hashable(query.select_related),
+        query.max_depth,
+        frozenset(query.deferred_loading[0]),
+        query.deferred_loading[1],
+        query.low_mark != 0,
+        query.high_mark is not None,
+    )
+    return shape, tuple(values)
+
+
+class QueryShapeCache(object):
+    """
+    A bounded, process-local LRU map of query shape => SQL template digest.
+
+    The first query of a given shape is compiled to learn its template; after
+    that every query with the same shape is keyed from the template digest
+    and its own parameters, without touching the compiler.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.templates = collections.OrderedDict()
+
+    def get(self, shape):
+        template = self.templates.pop(shape, None)
+        if template is not None:
+            # Re-insert to mark the shape as most recently used.
+            self.templates[shape] = template
+        return template
+
+    def set(self, shape, template):
+        if len(self.templates) >= self.size:
+            try:
+                self.templates.popitem(last=False)
+            except KeyError:
+                pass
+        self.templates[shape] = template
+
+    def clear(self):
+        self.templates.clear()
+
+
+shape_cache = QueryShapeCache(config.QUERY_SHAPE_CACHE_SIZE)
+
+
+def compile_key(query, using):
+    """Hash the fully compiled SQL for ``query``; the pre-shape-cache key."""
+    sql, params = query.clone().get_compiler(using=using).as_sql()
+    return hashlib.md5(encoding.smart_bytes(sql % params)).hexdigest()
+
+
+def shape_key(query, using, shape):
+    """Hash the template for ``shape`` together with its parameter values."""
+    shape, values = shape
+    template = shape_cache.get(shape)
+    if template is None:
+        sql, _ = query.clone().get_compiler(using=using).as_sql()
+        template = hashlib.md5(encoding.smart_bytes(sql)).hexdigest()
+        shape_cache.set(shape, template)
+    return hashlib.md5(
+        encoding.smart_bytes("%s:%r" % (template, values))
+    ).hexdigest()
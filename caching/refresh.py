@@ -0,0 +1,149 @@
+from __future__ import unicode_literals
+
+import collections
+import logging
+import math
+import os
+import random
+import threading
+import time
+
+from six.moves import queue
+
+from django.db import connections
+
+from caching import config
+
+logger = logging.getLogger("caching.refresh")
+
+# A cached value with its soft expiry: past ``refresh_at`` it's still served,
+# but a refresh gets queued.
+Stamped = collections.namedtuple("Stamped", "value refresh_at")
+
+
+# A cached value with how long it took to compute and when it expires, for
+# probabilistic early recomputation.
+Timed = collections.namedtuple("Timed", "value delta expiry")
+
+
+def stamp(value):
+    """Wrap ``value`` with a soft expiry, if stale-while-revalidate is on."""
+    if not config.REFRESH_AFTER:
+        return value
+    return Stamped(value, time.time() + config.REFRESH_AFTER)
+
+
+def timed(value, delta, timeout):
+    """Wrap ``value`` with its compute time ``delta`` and its expiry."""
+    if config.XFETCH_BETA is None or not timeout:
+        return value
+    return Timed(value, delta, time.time() + timeout)
+
+
+def untimed(value):
+    return value.value if isinstance(value, Timed) else value
+
+
+def recompute_early(value):
+    """
+    Decide whether to recompute ``value`` before it expires (XFetch).
+
+    The closer to its expiry, and the longer it took to compute, the likelier
+    we are to recompute it; so hot keys get refreshed by a single caller a
+    bit ahead of time rather than by everyone at once when they expire.
+    """
+    if not isinstance(value, Timed) or config.XFETCH_BETA is None:
+        return False
+    # 1 - random() is in (0, 1], log() of it is <= 0.
+    gap = value.delta * config.XFETCH_BETA * math.log(1 - random.random())
+    return time.time() - gap >= value.expiry
+
+
+class RefreshPool(object):
+    """
+    A bounded pool of daemon threads refreshing soft-expired values.
+
+    Refreshes for a key that's already queued are dropped, and so is anything
+    submitted while the queue is full: the stale value just gets served a
+    little longer.
+    """
+
+    def __init__(self, threads, size):
+        self.threads = threads
+        self.queue = queue.Queue(size)
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.pid = None
+
+    def start(self):
+        # Threads don't survive a fork, start them in every process.
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        for i in range(self.threads):
+            thread = threading.Thread(target=self.work, name="cache-machine-refresh")
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, key, job):
+        with self.lock:
+            if key in self.pending:
+                return
+            self.pending.add(key)
+        try:
+            self.start()
+            self.queue.put_nowait((key, job))
+        except queue.Full:
+            logger.debug("refresh queue full, dropping %s" % key)
+            self.done(key)
+
+    def done(self, key):
+        with self.lock:
+            self.pending.discard(key)
+
+    def work(self):
+        while True:
+            key, job = self.queue.get()
+            try:
+                job()
+            except Exception:
+                logger.exception("refreshing %s failed" % key)
+            finally:
+                self.done(key)
+                # Don't leak this thread's database connections.
+                connections.close_all()
+
+
+pool = RefreshPool(config.REFRESH_THREADS, config.REFRESH_QUEUE_SIZE)
+
+
+def unstamp(invalidator, key, value, compute, store):
+    """
+    Return the plain value of what was read from ``key``.
+
+    If ``value`` is past its soft expiry, queue a refresh: ``compute()`` runs
+    in the background and its result is handed to ``store()``, unless ``key``
+    was invalidated or refreshed in the meantime.
+    """
+    if not isinstance(value, Stamped):
+        return value
+    if value.refresh_at <= time.time():
+        pool.submit(key, lambda: refresh(invalidator, key, value, compute, store))
+    return value.value
+
+
+def refresh(invalidator, key, stamped, compute, store):
+    # One refresh per key across processes, too.
+    lock = "refresh:%s" % key
+    token = invalidator.lock(lock, max(int(config.REFRESH_AFTER), 1))
+    if not token:
+        return
+    try:
+        value = compute()
+        current = invalidator.get(key)
+        # A hard delete means it was invalidated while we were computing and
+        # our value may predate the write.
+        if isinstance(current, Stamped) and current.refresh_at == stamped.refresh_at:
+            store(value)
+    finally:
+        invalidator.unlock(lock, token)
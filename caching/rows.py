@@ -0,0 +1,70 @@
+from __future__ import unicode_literals
+
+import collections
+import hashlib
+
+from django.utils import encoding
+
+# Compact form of a cached result: concrete field values as tuples, and a
+# fingerprint of the model's schema they were taken from.
+Rows = collections.namedtuple("Rows", "fingerprint rows")
+
+# A result cached in chunks: the keys of the chunks, in order, and the total
+# number of objects.
+Manifest = collections.namedtuple("Manifest", "keys count")
+
+# A result cached as the primary keys of its objects, in order, with
+# FETCH_BY_ID; the objects are cached on their own.
+Ids = collections.namedtuple("Ids", "pks")
+
+_fingerprints = {}
+
+
+def fingerprint(model):
+    """Hash the concrete fields of ``model``, in order, with their types."""
+    try:
+        return _fingerprints[model]
+    except KeyError:
+        meta = model._meta
+        parts = ["%s.%s" % (meta.app_label, meta.model_name)]
+        parts.extend(
+            "%s:%s:%s" % (f.attname, f.column, f.get_internal_type())
+            for f in meta.concrete_fields
+        )
+        _fingerprints[model] = hashlib.md5(
+            encoding.smart_bytes(",".join(parts))
+        ).hexdigest()
+        return _fingerprints[model]
+
+
+def pack(model, objects):
+    """
+    Turn ``objects`` into ``Rows``, or return them untouched if that would
+    lose information: instances of other classes or with deferred fields.
+    """
+    attnames = [f.attname for f in model._meta.concrete_fields]
+    rows = []
+    for obj in objects:
+        if type(obj) is not model:
+            return objects
+        try:
+            rows.append(tuple(obj.__dict__[name] for name in attnames))
+        except KeyError:
+            # A deferred field; reading it would hit the database.
+            return objects
+    return Rows(fingerprint(model), rows)
+
+
+def unpack(model, db, cached):
+    """
+    Rebuild instances from ``Rows`` with ``Model.from_db``.
+
+    Returns None, i.e. a cache miss, if the rows were cached with another
+    version of the model's schema.
+    """
+    if not isinstance(cached, Rows):
+        return cached
+    if cached.fingerprint != fingerprint(model):
+        return None
+    attnames = [f.attname for f in model._meta.concrete_fields]
+    return [model.from_db(db, attnames, row) for row in cached.rows]
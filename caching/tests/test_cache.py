@@ -1,7 +1,10 @@
 from __future__ import unicode_literals
 import logging
+import os
 import pickle
 import sys
+import threading
+import time
 
 if sys.version_info < (2, 7):
     import unittest2 as unittest
@@ -10,6 +13,8 @@ else:
 
 import django
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Q, QuerySet
 from django.test import TestCase, TransactionTestCase
 from django.utils import translation, encoding
 
@@ -20,7 +25,15 @@ else:
 
 import jinja2
 
-from caching import base, invalidation, config, compat
+from caching import (
+    base, invalidation, config, compat, dependencies, predicates, querykey, refresh, rows
+)
+from caching.codec import PLAIN, ZLIB
+from caching.invalidators import GenerationInvalidator, Invalidator, RedisInvalidator
+from caching.invalidators import base as base_invalidators
+from caching.invalidators.base import columns_key
+from caching.local import LocalCache, LocalChannel, RedisChannel, memo
+from caching.middleware import RequestMemoMiddleware
 
 from .testapp.models import Addon, User
 
@@ -50,6 +63,8 @@ class CachingTestCase(TestCase):
 
     def setUp(self):
         cache.clear()
+        if invalidation.local is not None:
+            invalidation.local.clear()
         self.old_timeout = config.TIMEOUT
         if getattr(settings, 'CACHE_MACHINE_USE_REDIS', False):
             invalidation.redis.flushall()
@@ -222,6 +237,390 @@ class CachingTestCase(TestCase):
         self.assertIs(cache.get(q.flush_key()), None)
         self.assertIs(cache.get('remove-me'), None)
 
+    def test_query_key_memoized(self):
+        """Keys are memoized on the queryset and survive a clone."""
+        q = Addon.objects.filter(val=42)
+        key = q.query_key()
+        with mock.patch('caching.base.compile_key') as compile_mock:
+            with mock.patch('caching.base.shape_key') as shape_mock:
+                self.assertEqual(q.query_key(), key)
+                self.assertEqual(q.cache(12).query_key(), key)
+                q.flush_key()
+        self.assertFalse(compile_mock.called)
+        self.assertFalse(shape_mock.called)
+
+    def test_query_key_changed_in_place(self):
+        """Changing the query in place changes its key."""
+        for q in (Addon.objects.filter(val=42),
+                  Addon.objects.filter(author1__name='fliggy')):
+            key = q.query_key()
+            q.query.add_q(Q(val=7))
+            self.assertNotEqual(q.query_key(), key)
+            key = q.query_key()
+            q.query.clear_ordering(True)
+            self.assertNotEqual(q.query_key(), key)
+
+    def test_query_shape_cache_lru(self):
+        shapes = querykey.QueryShapeCache(2)
+        shapes.set('a', 1)
+        shapes.set('b', 2)
+        self.assertEqual(shapes.get('a'), 1)
+        shapes.set('c', 3)
+        self.assertEqual((shapes.get('a'), shapes.get('b'), shapes.get('c')), (1, None, 3))
+
+    def test_query_shape_cache(self):
+        """Queries sharing a shape are keyed without compiling the SQL."""
+        querykey.shape_cache.clear()
+        key = Addon.objects.filter(val=42).query_key()
+        with mock.patch('django.db.models.sql.query.Query.get_compiler') as compiler:
+            other = Addon.objects.filter(val=17).query_key()
+            self.assertEqual(Addon.objects.filter(val=42).query_key(), key)
+        self.assertFalse(compiler.called)
+        self.assertNotEqual(key, other)
+        self.assertNotEqual(key, Addon.objects.exclude(val=42).query_key())
+        self.assertNotEqual(key, Addon.objects.filter(val=42)[:1].query_key())
+
+    @mock.patch('caching.config.QUERY_SHAPE_CACHE_SIZE', 0)
+    def test_query_shape_cache_disabled(self):
+        q = Addon.objects.filter(val=42)
+        self.assertEqual(q.query_key(), querykey.compile_key(q.query, q.db))
+
+    def test_local_cache(self):
+        """The local cache answers repeated reads until a key is invalidated."""
+        backend = mock.Mock()
+        backend.get.return_value = [1, 2]
+        inv = Invalidator(backend, log, local=LocalCache(10, 60))
+        self.assertEqual(inv.get('q'), [1, 2])
+        self.assertEqual(inv.get('q'), [1, 2])
+        self.assertEqual(backend.get.call_count, 1)
+
+        # Flush lists are never served locally.
+        inv.get(config.FLUSH_PREFIX + 'q')
+        inv.get(config.FLUSH_PREFIX + 'q')
+        self.assertEqual(backend.get.call_count, 3)
+
+        inv.channel.publish([inv.make_key('q')])
+        inv.get('q')
+        self.assertEqual(backend.get.call_count, 4)
+
+    def test_local_cache_invalidation(self):
+        channel = LocalChannel()
+        channel.subscribe(base.invalidator.drop_local)
+        with mock.patch.multiple(base.invalidator, create=True,
+                                 local=LocalCache(10, 60), channel=channel):
+            self.assertIs(Addon.objects.get(id=1).from_cache, False)
+            with mock.patch.object(cache, 'get') as get_mock:
+                self.assertIs(Addon.objects.get(id=1).from_cache, True)
+            self.assertFalse(get_mock.called)
+            Addon.objects.get(id=1).save()
+            self.assertIs(Addon.objects.get(id=1).from_cache, False)
+
+    def test_local_cache_subscription(self):
+        """Local copies are only used once invalidations are heard of."""
+        class Stop(BaseException):
+            pass
+
+        client = mock.Mock()
+        pubsub = client.pubsub.return_value
+        pubsub.listen.return_value = [
+            {'type': 'subscribe', 'data': 1},
+            {'type': 'message', 'data': '["k"]'},
+        ]
+        channel = RedisChannel(client, 'c')
+        received = []
+        channel.subscribe(received.append)
+        with mock.patch.object(threading.Thread, 'start') as start:
+            self.assertIs(channel.listen(), False)
+        start.assert_called_once_with()
+
+        # Whatever was cached before the subscription is dropped.
+        with mock.patch('caching.local.time.sleep', side_effect=Stop):
+            self.assertRaises(Stop, channel._listen)
+        self.assertEqual(received, [None, ['k'], None])
+        pubsub.subscribe.assert_called_once_with('c')
+
+        channel.subscribed = os.getpid()
+        self.assertIs(channel.listen(), True)
+
+    def test_local_cache_fill_race(self):
+        """Values read before an invalidation don't make it in."""
+        local = LocalCache(10, 60)
+        epoch = local.epoch
+        local.delete_many(['q'])
+        local.set('q', 'stale', epoch)
+        self.assertIs(local.get('q'), None)
+
+    def test_request_memo(self):
+        """Within a memo, repeated reads skip the backend until invalidated."""
+        self.assertIs(Addon.objects.get(id=1).from_cache, False)
+        with memo:
+            self.assertIs(Addon.objects.get(id=1).from_cache, True)
+            with mock.patch.object(cache, 'get') as get_mock:
+                self.assertIs(Addon.objects.get(id=1).from_cache, True)
+            self.assertFalse(get_mock.called)
+
+            Addon.objects.get(id=1).save()
+            self.assertIs(Addon.objects.get(id=1).from_cache, False)
+        self.assertEqual(memo.data, {})
+
+    def test_request_memo_fresh_objects(self):
+        """Changes to memoized objects don't leak into later lookups."""
+        with memo:
+            addon = Addon.objects.get(id=1)
+            addon.val = 999
+            again = Addon.objects.get(id=1)
+            self.assertIsNot(again, addon)
+            self.assertNotEqual(again.val, 999)
+            again.val = 998
+            self.assertNotEqual(Addon.objects.get(id=1).val, 998)
+
+    def test_request_memo_middleware(self):
+        middleware = RequestMemoMiddleware()
+        middleware.process_request(None)
+        self.assertEqual(memo.depth, 1)
+        Addon.objects.get(id=1)
+        self.assertTrue(memo.data)
+        response = object()
+        self.assertIs(middleware.process_response(None, response), response)
+        self.assertEqual((memo.depth, memo.data), (0, {}))
+
+    def test_miss_lock(self):
+        """The process holding the miss lock fills the cache and unlocks."""
+        q = Addon.objects.cache(lock_timeout=10).filter(id=1)
+        self.assertEqual(q.lock_timeout, 10)
+        with mock.patch.object(base.invalidator, 'lock', return_value='t') as lock:
+            with mock.patch.object(base.invalidator, 'unlock') as unlock:
+                self.assertIs(q.get().from_cache, False)
+        lock.assert_called_with(mock.ANY, 10)
+        unlock.assert_called_with(lock.call_args[0][0], 't')
+        self.assertIs(Addon.objects.filter(id=1).get().from_cache, True)
+
+    def test_miss_lock_owner(self):
+        """A lock that timed out and was taken again isn't released by us."""
+        token = base.invalidator.lock('q', 10)
+        self.assertTrue(token)
+        self.assertIs(base.invalidator.lock('q', 10), None)
+        base.invalidator.unlock('q', 'someone else')
+        self.assertIs(base.invalidator.lock('q', 10), None)
+        base.invalidator.unlock('q', token)
+        self.assertTrue(base.invalidator.lock('q', 10))
+
+    @mock.patch('caching.config.MISS_LOCK_POLL', 0)
+    def test_miss_lock_wait(self):
+        """Without the lock, we wait for the holder to cache the result."""
+        addons = list(Addon.objects.filter(id=1))
+        q = Addon.objects.cache(lock_timeout=10, lock_wait=5).filter(id=1)
+        get = mock.Mock(side_effect=[None, None, addons])
+        with mock.patch.object(base.invalidator, 'lock', return_value=False):
+            with mock.patch.object(base.invalidator, 'get', get):
+                with self.assertNumQueries(0):
+                    self.assertIs(q.get().from_cache, True)
+        self.assertEqual(get.call_count, 3)
+
+    @mock.patch('caching.config.MISS_LOCK_STALE', True)
+    def test_miss_lock_stale(self):
+        """Past the wait budget we serve the stale copy, if there's one."""
+        q = Addon.objects.cache(lock_timeout=10, lock_wait=0).filter(id=1)
+        self.assertIs(q.get().from_cache, False)
+        Addon.objects.get(id=1).save()
+        with mock.patch.object(base.invalidator, 'lock', return_value=False):
+            with self.assertNumQueries(0):
+                self.assertIs(q.get().from_cache, True)
+
+        # With no stale copy around, we run the query ourselves.
+        cache.clear()
+        with mock.patch.object(base.invalidator, 'lock', return_value=False):
+            self.assertIs(q.get().from_cache, False)
+
+    @mock.patch('caching.config.REFRESH_AFTER', -1)
+    @mock.patch('caching.refresh.pool.submit')
+    def test_stale_while_revalidate(self, submit):
+        """Soft-expired results are served while a refresh is queued."""
+        self.assertEqual(Addon.objects.get(id=1).val, 42)
+        # Change it behind the cache's back.
+        QuerySet(Addon).filter(id=1).update(val=17)
+
+        a = Addon.objects.get(id=1)
+        self.assertEqual((a.val, a.from_cache), (42, True))
+        self.assertEqual(submit.call_count, 1)
+        key, job = submit.call_args[0]
+        job()
+        self.assertEqual(Addon.objects.get(id=1).val, 17)
+
+        # Invalidation still hard-deletes.
+        a.save()
+        self.assertIs(Addon.objects.get(id=1).from_cache, False)
+
+    @mock.patch('caching.config.REFRESH_AFTER', -1)
+    @mock.patch('caching.refresh.pool.submit')
+    def test_stale_while_revalidate_invalidated(self, submit):
+        """A refresh racing with an invalidation doesn't store anything."""
+        Addon.objects.get(id=1)
+        Addon.objects.get(id=1)
+        key, job = submit.call_args[0]
+        Addon.objects.get(id=1).save()
+        job()
+        self.assertIs(base.invalidator.get(key), None)
+
+    @mock.patch('caching.config.REFRESH_AFTER', -1)
+    @mock.patch('caching.refresh.pool.submit')
+    def test_cached_stale_while_revalidate(self, submit):
+        counter = mock.Mock(side_effect=[1, 2])
+        self.assertEqual(base.cached(counter, 'key'), 1)
+        self.assertEqual(base.cached(counter, 'key'), 1)
+        submit.call_args[0][1]()
+        self.assertEqual(base.cached(counter, 'key'), 2)
+
+    @mock.patch('caching.config.XFETCH_BETA', 1)
+    @mock.patch('caching.refresh.random.random', return_value=0.5)
+    def test_cached_recompute_early(self, random):
+        """Values get recomputed early with a probability rising near expiry."""
+        counter = mock.Mock(side_effect=[1, 2])
+        self.assertEqual(base.cached(counter, 'key', 60), 1)
+        self.assertEqual(base.cached(counter, 'key', 60), 1)
+
+        # Took 10s to compute, ln(0.5) * 10 is about -7s: 5s before expiry
+        # we recompute, 60s before we don't.
+        now = time.time()
+        self.assertTrue(refresh.recompute_early(refresh.Timed(1, 10, now + 5)))
+        self.assertFalse(refresh.recompute_early(refresh.Timed(1, 10, now + 60)))
+
+        key = base._function_cache_key('key')
+        base.invalidator.set(key, refresh.Timed(1, 10, now + 5), 60)
+        self.assertEqual(base.cached(counter, 'key', 60), 2)
+        self.assertEqual(counter.call_count, 2)
+
+    @mock.patch('caching.config.COMPACT_ROWS', True)
+    def test_compact_rows(self):
+        """Results are cached as tuples of field values and rebuilt on a hit."""
+        q = Addon.objects.filter(id=1)
+        self.assertIs(list(q)[0].from_cache, False)
+        key = q._iterable_class(q).query_key()
+        self.assertEqual(base.invalidator.get(key),
+                         rows.Rows(rows.fingerprint(Addon), [(1, 42, 2, 1)]))
+        a = list(q.all())[0]
+        self.assertIs(a.from_cache, True)
+        self.assertEqual((a.val, a.author1_id, a._state.db), (42, 2, 'default'))
+        self.assertFalse(a._state.adding)
+
+        # Deferred fields and select_related() results are pickled as usual.
+        self.assertIs(Addon.objects.only('val').get(id=1).from_cache, False)
+        self.assertIs(Addon.objects.only('val').get(id=1).from_cache, True)
+        a = Addon.objects.select_related('author1').get(id=1)
+        a = Addon.objects.select_related('author1').get(id=1)
+        with self.assertNumQueries(0):
+            self.assertEqual(a.author1.name, 'clouseroo')
+
+    @mock.patch('caching.config.COMPACT_ROWS', True)
+    def test_compact_rows_schema_change(self):
+        """Rows cached with another schema are ignored and replaced."""
+        self.assertIs(Addon.objects.get(id=1).from_cache, False)
+        with mock.patch.dict(rows._fingerprints, {Addon: 'changed'}):
+            self.assertIs(Addon.objects.get(id=1).from_cache, False)
+            self.assertIs(Addon.objects.get(id=1).from_cache, True)
+
+    @mock.patch('caching.config.COMPRESS_MIN_SIZE', 100)
+    def test_compression(self):
+        """Values above the size threshold are compressed, others are not."""
+        codec = base.invalidator.codec
+        codec.stats.clear()
+        base.invalidator.set('big', 'x' * 1000, 60)
+        base.invalidator.set('small', 'x', 60)
+        self.assertTrue(cache.get(base.invalidator.make_key('big')).startswith(ZLIB))
+        self.assertTrue(cache.get(base.invalidator.make_key('small')).startswith(PLAIN))
+        self.assertEqual(base.invalidator.get('big'), 'x' * 1000)
+        self.assertEqual(base.invalidator.get('small'), 'x')
+        self.assertEqual((codec.stats['compressed'], codec.stats['compressed_hits']), (1, 1))
+        self.assertLess(codec.stats['compressed_bytes'], codec.stats['raw_bytes'])
+
+        # Uncompressed entries written before are still readable.
+        cache.set(base.invalidator.make_key('old'), 'x' * 1000)
+        self.assertEqual(base.invalidator.get('old'), 'x' * 1000)
+
+    @mock.patch('caching.config.COMPRESS_MIN_SIZE', 0)
+    def test_compression_model_override(self):
+        q = Addon.objects.filter(id=1)
+        list(q)
+        key = base.invalidator.make_key(q._iterable_class(q).query_key())
+        self.assertTrue(cache.get(key).startswith(ZLIB))
+        self.assertIs(list(q.all())[0].from_cache, True)
+
+        cache.clear()
+        with mock.patch.object(Addon, 'cache_compress_min_size', None):
+            list(q.all())
+        self.assertIsInstance(cache.get(key), list)
+
+    @mock.patch('caching.config.CHUNK_SIZE', 1)
+    def test_chunked_results(self):
+        q = Addon.objects.all()
+        list(q)
+        manifest = base.invalidator.get(q._iterable_class(q).query_key())
+        self.assertIsInstance(manifest, rows.Manifest)
+        self.assertEqual((len(manifest.keys), manifest.count), (2, 2))
+
+        # Chunks are only fetched as we get to them.
+        with mock.patch.object(base.invalidator, 'get_many',
+                               wraps=base.invalidator.get_many) as get_many:
+            it = iter(q.all().iterator())
+            self.assertIs(next(it).from_cache, True)
+            self.assertEqual(get_many.call_count, 1)
+            self.assertIs(next(it).from_cache, True)
+            self.assertEqual(get_many.call_count, 2)
+
+        # The manifest and its chunks are invalidated together.
+        Addon.objects.get(id=1).save()
+        for key in [q._iterable_class(q).query_key()] + manifest.keys:
+            self.assertIsNone(cache.get(base.invalidator.make_key(key)))
+
+    @mock.patch('caching.config.CHUNK_SIZE', 1)
+    def test_chunked_results_missing_chunk(self):
+        q = Addon.objects.all()
+        expected = [a.id for a in q]
+        manifest = base.invalidator.get(q._iterable_class(q).query_key())
+        cache.delete(base.invalidator.make_key(manifest.keys[1]))
+        if invalidation.local is not None:
+            invalidation.local.clear()
+
+        # We carry on from the database past the missing chunk, and refill.
+        addons = list(q.all())
+        self.assertEqual([a.id for a in addons], expected)
+        self.assertEqual([a.from_cache for a in addons], [True, False])
+        self.assertTrue(all(a.from_cache for a in q.all()))
+
+    @mock.patch('caching.config.MAX_ROWS', 1)
+    def test_max_rows(self):
+        hits = base.CachingModelIterable.ceiling_hits['rows']
+        self.assertEqual(len(list(Addon.objects.all().iterator())), 2)
+        self.assertEqual([a.from_cache for a in Addon.objects.all()], [False, False])
+        self.assertEqual(base.CachingModelIterable.ceiling_hits['rows'], hits + 2)
+
+        # Small enough results are still cached.
+        list(Addon.objects.filter(id=1))
+        self.assertIs(list(Addon.objects.filter(id=1))[0].from_cache, True)
+
+    def test_max_bytes(self):
+        hits = base.CachingModelIterable.ceiling_hits['bytes']
+        with mock.patch('caching.config.MAX_BYTES', 1):
+            list(Addon.objects.filter(id=1))
+        self.assertEqual(base.CachingModelIterable.ceiling_hits['bytes'], hits + 1)
+        with mock.patch('caching.config.MAX_BYTES', 10 ** 6):
+            self.assertIs(Addon.objects.filter(id=1)[0].from_cache, False)
+            self.assertIs(Addon.objects.filter(id=1)[0].from_cache, True)
+
+    @mock.patch('caching.config.MISS_LOCK_TIMEOUT', 10)
+    @mock.patch('caching.config.MAX_ROWS', 0)
+    def test_max_rows_releases_lock(self):
+        q = Addon.objects.filter(id=1)
+        query_key = q._iterable_class(q).query_key()
+        it = iter(q.iterator())
+        next(it)
+        # Nothing will be cached, so whoever's waiting may as well go ahead.
+        self.assertTrue(base.invalidator.lock(query_key, 10))
+
+    @unittest.skipUnless(django.VERSION[:2] >= (1, 11), 'no chunked fetch')
+    def test_iterator_chunked_fetch(self):
+        self.assertIs(Addon.objects.all().iterator().chunked_fetch, True)
+
     def test_jinja_cache_tag_queryset(self):
         env = jinja2.Environment(extensions=['caching.ext.cache'])
 
@@ -344,6 +743,139 @@ class CachingTestCase(TestCase):
         self.assertEqual(f(), 2)
         self.assertEqual(f(), 2)
 
+    def test_cached_with_hit_writes_nothing(self):
+        """The flush list is only updated on a miss."""
+        a = Addon.objects.get(id=1)
+        with mock.patch.object(base.invalidator, 'add_to_flush_list') as add:
+            self.assertEqual(base.cached_with(a, lambda: 1, 'key'), 1)
+            self.assertEqual(base.cached_with(a, lambda: 2, 'key'), 1)
+        add.assert_called_once_with(
+            {a.flush_key(): [base._function_cache_key('key:%s' % a.cache_key)]},
+            base.DEFAULT_TIMEOUT)
+
+    def test_flush_list_expiry(self):
+        inv = base.invalidator
+        with mock.patch('caching.invalidators.base.time') as time_mock:
+            time_mock.time.return_value = 1000
+            inv.add_to_flush_list({'flush:test': ['a', 'forever']}, 60)
+            inv.add_to_flush_list({'flush:test': ['forever']}, None)
+        self.assertEqual(inv.get_many(['flush:test']),
+                         {'flush:test': {'a': 1060, 'forever': None}})
+        # Dead entries go the next time the list is written.
+        with mock.patch('caching.invalidators.base.time') as time_mock:
+            time_mock.time.return_value = 1061
+            inv.add_to_flush_list({'flush:test': ['b']}, 10)
+        self.assertEqual(inv.get_flush_lists(['flush:test']), set(['forever', 'b']))
+
+    def test_flush_list_timeout(self):
+        with mock.patch.object(base.invalidator, 'set_many') as set_many:
+            with mock.patch('caching.invalidators.base.time') as time_mock:
+                time_mock.time.return_value = 1000
+                base.invalidator.add_to_flush_list({'flush:test': ['a']}, 60)
+        set_many.assert_called_once_with({'flush:test': {'a': 1060}}, 60)
+
+    def test_flush_list_older_format(self):
+        cache.set(base.invalidator.make_key('flush:test'), set(['a']))
+        base.invalidator.add_to_flush_list({'flush:test': ['b']}, 60)
+        self.assertEqual(base.invalidator.get_flush_lists(['flush:test']), set(['a', 'b']))
+
+    @mock.patch('caching.config.FLUSH_LIST_MAX_SIZE', 2)
+    def test_flush_list_max_size(self):
+        list(Addon.objects.filter(id=1))
+        list(Addon.objects.filter(val=42))
+        self.assertEqual([a.from_cache for a in Addon.objects.filter(val=42)], [True, True])
+        # Addon 1 is in a third query: it's too many.
+        list(Addon.objects.all())
+        self.assertEqual([a.from_cache for a in Addon.objects.filter(val=42)], [False, False])
+        self.assertEqual([a.from_cache for a in Addon.objects.all()], [True, True])
+
+    @mock.patch('caching.config.FLUSH_LIST_SHARDS', 4)
+    def test_flush_list_shards(self):
+        inv = base.invalidator
+        q = Addon.objects.all()
+        list(q)
+        shards = inv.shard_keys([q.flush_key()])
+        self.assertEqual(len(shards), 4)
+        self.assertEqual(inv.get_flush_lists([q.flush_key()]),
+                         set([q._iterable_class(q).query_key()]))
+        with mock.patch.object(cache, 'get_many', wraps=cache.get_many) as get_many:
+            inv.get_flush_lists([q.flush_key(), 'flush:other'])
+        get_many.assert_called_once_with(list(map(inv.make_key, shards + [
+            'flush:other:0', 'flush:other:1', 'flush:other:2', 'flush:other:3'])))
+        Addon.objects.get(id=1).save()
+        self.assertEqual([a.from_cache for a in q], [False, False])
+
+    @mock.patch('caching.config.FLUSH_LIST_CAS', True)
+    def test_flush_list_cas(self):
+        class Client(object):
+            __module__ = 'pymemcache.client.hash'
+
+            def __init__(self):
+                self.data = {}
+
+            def gets(self, key):
+                return self.data.get(key, (None, None))
+
+            def add(self, key, value, timeout):
+                return self.data.setdefault(key, (value, 1))[0] is value
+
+            def cas(self, key, value, token, timeout):
+                if self.data[key][1] != token:
+                    return False
+                self.data[key] = (value, token + 1)
+                return True
+
+        client = Client()
+        cache_mock = mock.Mock(spec=['make_key', 'get_backend_timeout', '_cache'])
+        cache_mock.make_key.side_effect = lambda key: ':1:%s' % key
+        cache_mock.get_backend_timeout.side_effect = lambda timeout: timeout
+        cache_mock._cache = client
+        inv = Invalidator(cache=cache_mock, logger=log)
+        inv.add_to_flush_list({'flush:o:1': ['a']}, 60)
+        cas = client.cas
+
+        def racing_cas(key, value, token, timeout):
+            # Someone else adds 'b' between our gets and cas.
+            client.cas = cas
+            cas(key, inv.codec.encode({'a': None, 'b': None}), token, timeout)
+            return cas(key, value, token, timeout)
+
+        client.cas = racing_cas
+        inv.add_to_flush_list({'flush:o:1': ['c']}, 60)
+        value, token = client.gets(':1:ormcache:flush:o:1')
+        self.assertEqual(set(inv.codec.decode(value)), set(['a', 'b', 'c']))
+        self.assertEqual(token, 3)
+
+        # When others keep winning, the list is invalidated, not overwritten.
+        client.cas = mock.Mock(return_value=False)
+        with mock.patch.object(inv, 'invalidate_keys') as invalidate:
+            inv.add_to_flush_list({'flush:o:1': ['d', 'qs:flush:q']}, 60)
+        self.assertEqual(client.cas.call_count, base_invalidators.CAS_ATTEMPTS)
+        invalidate.assert_called_once_with(set(['d']), set(['flush:o:1', 'qs:flush:q']))
+        self.assertEqual(client.gets(':1:ormcache:flush:o:1'), (value, token))
+
+    @mock.patch('caching.config.FLUSH_LIST_CAS', True)
+    def test_flush_list_cas_python_memcached(self):
+        class Client(object):
+            # python-memcached: gets returns the value alone.
+            __module__ = 'memcache'
+
+            def gets(self, key):
+                return None
+
+            def cas(self, key, value, timeout):
+                return True
+
+        cache_mock = mock.Mock(spec=['make_key', '_cache'])
+        cache_mock._cache = Client()
+        inv = Invalidator(cache=cache_mock, logger=log)
+        self.assertIs(inv.cas_client(), None)
+        with mock.patch.object(inv, 'get_many', return_value={}) as get_many, \
+                mock.patch.object(inv, 'set_many') as set_many:
+            inv.add_to_flush_list({'flush:o:1': ['a']}, 60)
+        self.assertTrue(get_many.called)
+        self.assertEqual(list(set_many.call_args[0][0]), ['flush:o:1'])
+
     def test_cached_with_bad_object(self):
         """cached_with shouldn't fail if the object is missing a cache key."""
         counter = mock.Mock()
@@ -527,6 +1059,38 @@ class CachingTestCase(TestCase):
         User.objects.create(name='spam')
         self.assertTrue(all([u.from_cache for u in User.objects.all()]))
 
+    @mock.patch('caching.config.CACHE_INVALIDATE_ON_CREATE', config.MATCHING)
+    def test_invalidate_on_create_matching(self):
+        list(User.objects.all())
+        list(User.objects.filter(name__startswith='fli'))
+        list(User.objects.filter(name='clouseroo'))
+        list(User.objects.filter(addon__val=42).distinct())
+        User.objects.create(name='flipper')
+        self.assertEqual([u.from_cache for u in User.objects.filter(name='clouseroo')], [True])
+        # The new user may be in those.
+        self.assertEqual([(u.name, u.from_cache) for u in User.objects.all()],
+                         [('fliggy', False), ('clouseroo', False), ('flipper', False)])
+        self.assertEqual([(u.name, u.from_cache) for u in
+                          User.objects.filter(name__startswith='fli')],
+                         [('fliggy', False), ('flipper', False)])
+        # Joins can't be checked.
+        self.assertFalse(any(u.from_cache for u in
+                             User.objects.filter(addon__val=42).distinct()))
+
+    def test_predicates(self):
+        predicate = predicates.query_predicate
+        matches = predicates.matches
+        p = predicate(User.objects.exclude(name='Fliggy').query)
+        self.assertEqual(matches(p, User(name='x')), True)
+        # The database may not care about case.
+        self.assertEqual(matches(p, User(name='fliggy')), None)
+        self.assertEqual(matches(p, User(name='Fliggy')), False)
+        p = predicate(Addon.objects.filter(val__in=[1, 2], author1=2).query)
+        self.assertEqual(matches(p, Addon(val='2', author1_id=2)), True)
+        self.assertEqual(matches(p, Addon(val=3, author1_id=2)), False)
+        self.assertEqual(matches(p, Addon(val=None, author1_id=2)), None)
+        self.assertEqual(predicate(Addon.objects.filter(author1__name='a').query), None)
+
     def test_pickle_queryset(self):
         """
         Test for CacheingQuerySet.__getstate__ and CachingQuerySet.__setstate__.
@@ -574,6 +1138,505 @@ class CachingTestCase(TestCase):
                 self.assertEqual(len(result), 2)
                 self.assertIsInstance(result[0], tuple)
 
+    def test_update_invalidates(self):
+        list(Addon.objects.all())
+        with mock.patch.object(base.invalidator, 'invalidate_keys',
+                               wraps=base.invalidator.invalidate_keys) as invalidate:
+            self.assertEqual(Addon.objects.all().update(val=7), 2)
+        self.assertEqual(invalidate.call_count, 1)
+        addons = list(Addon.objects.all())
+        self.assertEqual([(a.val, a.from_cache) for a in addons], [(7, False), (7, False)])
+
+    def test_update_fk(self):
+        u = User.objects.create(name='new')
+        Addon.objects.create(val=1, author1=u, author2=u)
+        self.assertEqual(len(u.addon_set.all()), 1)
+        self.assertTrue(all(a.from_cache for a in u.addon_set.all()))
+
+        # Both the objects pointed to before and after get invalidated.
+        old = list(User.objects.get(id=2).addon_set.all())
+        Addon.objects.filter(id=1).update(author1=u)
+        addons = list(u.addon_set.all())
+        self.assertEqual(len(addons), 2)
+        self.assertFalse(any(a.from_cache for a in addons))
+        self.assertEqual(len(User.objects.get(id=2).addon_set.all()), len(old) - 1)
+
+    def test_delete_invalidates_once(self):
+        list(Addon.objects.all())
+        with mock.patch.object(base.invalidator, 'invalidate_keys',
+                               wraps=base.invalidator.invalidate_keys) as invalidate:
+            Addon.objects.all().delete()
+        self.assertEqual(invalidate.call_count, 1)
+        self.assertEqual(list(Addon.objects.all()), [])
+
+    def test_bulk_create_invalidates(self):
+        user = User.objects.get(id=2)
+        self.assertEqual(len(user.addon_set.all()), 2)
+        Addon.objects.bulk_create([Addon(val=1, author1=user, author2=user)])
+        addons = list(user.addon_set.all())
+        self.assertEqual(len(addons), 3)
+        self.assertFalse(any(a.from_cache for a in addons))
+
+    @unittest.skipUnless(hasattr(QuerySet, 'bulk_update'), 'no bulk_update')
+    def test_bulk_update_invalidates(self):
+        addons = list(Addon.objects.all())
+        for addon in addons:
+            addon.val = 3
+        Addon.objects.bulk_update(addons, ['val'])
+        self.assertEqual([(a.val, a.from_cache) for a in Addon.objects.all()],
+                         [(3, False), (3, False)])
+
+    @mock.patch('caching.config.BULK_INVALIDATE_MAX_ROWS', 1)
+    def test_bulk_invalidate_max_rows(self):
+        list(Addon.objects.filter(val=42))
+        with mock.patch.object(base.invalidator, 'invalidate_keys',
+                               wraps=base.invalidator.invalidate_keys) as invalidate:
+            Addon.objects.all().update(val=7)
+        invalidate.assert_called_once_with(set(), set([Addon.model_flush_key()]))
+        # That was enough to drop queries on the model.
+        self.assertEqual(list(Addon.objects.filter(val=42)), [])
+
+    @mock.patch('caching.config.BULK_INVALIDATE_MAX_ROWS', 1)
+    def test_bulk_invalidate_max_rows_delete(self):
+        """Past the limit, the keys of the rows deleted stop being computed."""
+        with mock.patch.object(base.invalidator, 'object_keys',
+                               wraps=base.invalidator.object_keys) as object_keys:
+            Addon.objects.all().delete()
+        # Only for the first one.
+        self.assertEqual(object_keys.call_count, 1)
+
+    def test_update_reads_from_writer(self):
+        """Rows are read from the database written to, not a replica."""
+        with mock.patch.object(base.CachingQuerySet, '_invalidate_rows',
+                               autospec=True, return_value=None) as invalidate:
+            Addon.objects.filter(id=1).update(val=7)
+        self.assertIs(invalidate.call_args[0][1]._for_write, True)
+
+    def _redis_invalidator(self):
+        cache_mock = mock.Mock(spec=['make_key', 'add', 'delete_many', 'client', '_client'])
+        cache_mock.make_key.side_effect = lambda key: ':1:%s' % key
+        # django-redis, on the Redis holding the flush lists.
+        cache_mock.client.get_client.return_value = cache_mock._client
+        return RedisInvalidator(cache=cache_mock, logger=log)
+
+    @mock.patch('caching.config.REDIS_FLUSH_SCRIPT', True)
+    def test_redis_flush_script(self):
+        inv = self._redis_invalidator()
+        self.assertEqual(inv.key_template, (':1:', ''))
+        inv.flush_script.return_value = [[b'ormcache:o:1', b'ormcache:q'], []]
+        with mock.patch.object(inv, 'forget') as forget:
+            inv.invalidate_keys(['o:1'], ['flush:o:1'])
+        kwargs = inv.flush_script.call_args[1]
+        self.assertEqual(kwargs['keys'], ['ormcache:flush:o:1'])
+        self.assertEqual(kwargs['args'], ['ormcache:', 'flush:', 1000, ':1:', '', 'ormcache:o:1'])
+        forget.assert_called_once_with(['ormcache:o:1', 'ormcache:q'])
+        # Everything happened in the script.
+        self.assertFalse(inv.client.sunion.called)
+        self.assertFalse(inv.client.delete.called)
+
+    @mock.patch('caching.config.REDIS_FLUSH_SCRIPT', True)
+    def test_redis_flush_script_limit(self):
+        inv = self._redis_invalidator()
+        inv.flush_script.return_value = [[], [b'ormcache:flush:deep']]
+        inv.client.sunion.return_value = [b'ormcache:q']
+        inv.invalidate_keys(['o:1'], ['flush:o:1'])
+        # Lists past the limit get expanded the usual way.
+        inv.client.sunion.assert_called_once_with(['ormcache:flush:deep'])
+        inv.client.delete.assert_called_once_with('ormcache:flush:deep')
+
+    def test_fill_stats(self):
+        stats = base.invalidator.fill_stats
+        fills, trips = stats['fills'], stats['round_trips']
+        list(Addon.objects.all())
+        self.assertEqual(stats['fills'], fills + 1)
+        # The result, then reading and writing the flush lists.
+        self.assertEqual(stats['round_trips'], trips + 3)
+
+    @mock.patch('caching.config.FETCH_BY_ID', True)
+    def test_fetch_by_id_single_fill(self):
+        fills = base.invalidator.fill_stats['fills']
+        addons = list(Addon.objects.all())
+        self.assertEqual(base.invalidator.fill_stats['fills'], fills + 1)
+        self.assertEqual(base.invalidator.get(base.byid(addons[0])).id, addons[0].id)
+        self.assertTrue(all(a.from_cache for a in Addon.objects.all()))
+
+    @mock.patch('caching.config.FETCH_BY_ID', True)
+    def test_fetch_by_id_caches_ids(self):
+        addons = list(Addon.objects.all())
+        q = Addon.objects.all()
+        ids = base.invalidator.get(q._iterable_class(q).query_key())
+        self.assertEqual(ids, rows.Ids(tuple(a.pk for a in addons)))
+        with self.assertNumQueries(0):
+            cached = list(Addon.objects.all())
+        self.assertEqual(cached, addons)
+        self.assertTrue(all(a.from_cache for a in cached))
+
+        # Objects evicted on their own are read again, by primary key.
+        base.invalidator.invalidate_keys([base.byid(addons[0])], [])
+        with self.assertNumQueries(1):
+            cached = list(Addon.objects.all())
+        self.assertEqual(cached, addons)
+        self.assertIs(cached[0].from_cache, False)
+
+    @mock.patch('caching.config.FETCH_BY_ID', True)
+    @mock.patch('caching.config.FETCH_BY_ID_BATCH_SIZE', 1)
+    def test_fetch_by_id_batches(self):
+        pks = list(Addon.objects.values_list('pk', flat=True))
+        with self.assertNumQueries(len(pks)):
+            addons = list(Addon.objects.all().objects_by_id(pks))
+        self.assertEqual([a.pk for a in addons], pks)
+        with self.assertNumQueries(0):
+            self.assertEqual(list(Addon.objects.all().objects_by_id(pks)), addons)
+        # Objects that are gone are skipped.
+        self.assertEqual(list(Addon.objects.all().objects_by_id([999] + pks)), addons)
+
+    @mock.patch('caching.config.FETCH_BY_ID', True)
+    def test_fetch_stats(self):
+        stats = dict(base.CachingQuerySet.fetch_stats)
+        list(Addon.objects.all())
+        list(Addon.objects.all().objects_by_id([1, 2]))
+        self.assertEqual(base.CachingQuerySet.fetch_stats['batches'], stats.get('batches', 0) + 2)
+        self.assertEqual(base.CachingQuerySet.fetch_stats['hits'], stats.get('hits', 0) + 2)
+        self.assertEqual(base.CachingQuerySet.fetch_stats['misses'], stats.get('misses', 0) + 2)
+
+    @mock.patch('caching.config.OBJECT_LOOKUPS', True)
+    def test_object_lookups(self):
+        a = Addon.objects.get(pk=1)
+        self.assertIs(a.from_cache, False)
+        self.assertEqual(base.invalidator.get(base.byid(a)), a)
+        # Every lookup of the object shares its entry, without compiling SQL.
+        with mock.patch.object(base, 'compile_key') as compile_key, \
+                mock.patch.object(base, 'shape_key') as shape_key:
+            with self.assertNumQueries(0):
+                self.assertIs(Addon.objects.get(id=1).from_cache, True)
+                self.assertIs(Addon.objects.cache(30).get(pk__exact='1').from_cache, True)
+                self.assertEqual([x.from_cache for x in Addon.objects.filter(pk=1)], [True])
+        self.assertFalse(compile_key.called)
+        self.assertFalse(shape_key.called)
+
+        # Whereas a query needs a key, and so its SQL.
+        with mock.patch('caching.config.OBJECT_LOOKUPS', False):
+            with mock.patch.object(base, 'compile_key', return_value='k') as compile_key, \
+                    mock.patch.object(base, 'shape_key', return_value='k') as shape_key:
+                list(Addon.objects.filter(pk=1))
+        self.assertTrue(compile_key.called or shape_key.called)
+
+        # Anything more is a query of its own.
+        self.assertIs(Addon.objects.filter(pk=1, val=42).get().from_cache, False)
+        self.assertIs(Addon.objects.select_related('author1').get(pk=1).from_cache, False)
+        self.assertIs(Addon.objects.only('val').get(pk=1).from_cache, False)
+
+        a.val = 7
+        a.save()
+        a = Addon.objects.get(pk=1)
+        self.assertIs(a.from_cache, False)
+        self.assertEqual(a.val, 7)
+        a.delete()
+        self.assertRaises(Addon.DoesNotExist, Addon.objects.get, pk=1)
+
+    @mock.patch('caching.config.OBJECT_LOOKUPS', True)
+    def test_object_lookups_unique(self):
+        User.objects.filter(pk=1).update(email='a@example.com')
+        self.assertIs(User.objects.get(email='a@example.com').from_cache, False)
+        with self.assertNumQueries(0):
+            self.assertIs(User.objects.get(email='a@example.com').from_cache, True)
+            self.assertIs(User.objects.get(pk=1).from_cache, True)
+
+        # Changing the field invalidates the lookup.
+        u = User.objects.get(pk=1)
+        u.email = 'b@example.com'
+        u.save()
+        self.assertRaises(User.DoesNotExist, User.objects.get, email='a@example.com')
+        self.assertEqual(User.objects.get(email='b@example.com').pk, 1)
+
+    def test_in_bulk_off(self):
+        """Without CACHE_OBJECT_LOOKUPS, in_bulk() goes to the database."""
+        Addon.objects.in_bulk([1])
+        with self.assertNumQueries(1):
+            self.assertEqual(sorted(Addon.objects.in_bulk([1, 2])), [1, 2])
+
+    @mock.patch('caching.config.OBJECT_LOOKUPS', True)
+    def test_in_bulk(self):
+        with self.assertNumQueries(1):
+            addons = Addon.objects.in_bulk([1])
+        self.assertIs(addons[1].from_cache, False)
+        # Only the ids we haven't seen are read, in one query.
+        with self.assertNumQueries(1) as ctx:
+            addons = Addon.objects.in_bulk(['1', 2, 999])
+        self.assertIn('IN (2, 999)', ctx.captured_queries[0]['sql'])
+        self.assertEqual(sorted(addons), [1, 2])
+        self.assertIs(addons[1].from_cache, True)
+        with self.assertNumQueries(0):
+            self.assertEqual(Addon.objects.in_bulk([2, 1]), addons)
+        self.assertEqual(Addon.objects.in_bulk([]), {})
+
+        a = addons[2]
+        a.val = 7
+        a.save()
+        self.assertEqual(Addon.objects.in_bulk([2])[2].val, 7)
+
+        # Filtered querysets go to the database.
+        self.assertEqual(list(Addon.objects.filter(val=7).in_bulk([1, 2])), [2])
+
+    @mock.patch('caching.config.FOREIGN_KEYS', True)
+    def test_foreign_keys(self):
+        a = Addon.objects.no_cache().get(pk=1)
+        with self.assertNumQueries(1):
+            self.assertIs(a.author1.from_cache, False)
+        a = Addon.objects.no_cache().get(pk=1)
+        with self.assertNumQueries(0):
+            self.assertIs(a.author1.from_cache, True)
+
+        # Saving the related object invalidates its entry.
+        a.author1.name = 'changed'
+        a.author1.save()
+        a = Addon.objects.no_cache().get(pk=1)
+        self.assertEqual(a.author1.name, 'changed')
+        self.assertIs(a.author1.from_cache, False)
+
+    @mock.patch('caching.config.FOREIGN_KEYS', True)
+    def test_foreign_keys_primed(self):
+        addons = list(Addon.objects.all())
+        # A hit primes every author: one query for those not cached yet.
+        with self.assertNumQueries(1):
+            addons = list(Addon.objects.all())
+            self.assertTrue(all(a.from_cache for a in addons))
+        with self.assertNumQueries(0):
+            authors = [(a.author1, a.author2) for a in addons]
+        inv = base.invalidator
+        with mock.patch.object(inv, 'get_many', wraps=inv.get_many) as get_many:
+            with self.assertNumQueries(0):
+                self.assertEqual([(a.author1, a.author2) for a in Addon.objects.all()], authors)
+        self.assertEqual(get_many.call_count, 1)
+
+    @mock.patch('caching.config.FOREIGN_KEYS', True)
+    def test_foreign_keys_deferred(self):
+        """Deferred foreign keys aren't primed: loading them would recurse."""
+        list(Addon.objects.only('val'))
+        addons = list(Addon.objects.only('val'))
+        self.assertTrue(all(a.from_cache for a in addons))
+        self.assertEqual(addons[0].author1.pk, 2)
+
+    @mock.patch('caching.config.FOREIGN_KEYS', True)
+    @mock.patch('caching.config.CHUNK_SIZE', 1)
+    def test_foreign_keys_primed_chunks(self):
+        list(Addon.objects.all())
+        addons = list(Addon.objects.all())
+        self.assertTrue(all(a.from_cache for a in addons))
+        with self.assertNumQueries(0):
+            [(a.author1, a.author2) for a in addons]
+
+    @mock.patch('caching.config.MULTI_CHUNK_SIZE', 2)
+    def test_multi_chunks(self):
+        inv = Invalidator(base.invalidator.cache, log)
+        values = dict(('k%d' % i, i) for i in range(5))
+        with mock.patch.object(inv.cache, 'set_many', wraps=inv.cache.set_many) as set_many:
+            inv.set_many(values)
+        self.assertEqual(sorted(len(c[0][0]) for c in set_many.call_args_list), [1, 2, 2])
+        with mock.patch.object(inv.cache, 'get_many', wraps=inv.cache.get_many) as get_many:
+            self.assertEqual(inv.get_many(list(values) + ['nope']), values)
+        self.assertEqual(get_many.call_count, 3)
+
+        # Chunks go through the thread pool if the client can take it.
+        inv.concurrent = True
+        with mock.patch('caching.invalidators.base.thread_map', side_effect=map) as thread_map:
+            self.assertEqual(inv.cache_get_many(['k0', 'k1', 'k2']), {})
+        self.assertEqual(thread_map.call_count, 1)
+
+    def test_multi_concurrent(self):
+        """Threads are only used if the value cache's client is thread-safe."""
+        self.assertIs(self._redis_invalidator().concurrent, True)
+        # Flush lists in Redis, values in memcached.
+        memcached = mock.Mock(spec=['make_key', '_client', '_cache'])
+        memcached.make_key.side_effect = lambda key: ':1:%s' % key
+        self.assertIs(RedisInvalidator(cache=memcached, logger=log).concurrent, False)
+        with mock.patch('caching.config.MULTI_CONCURRENT', True):
+            self.assertIs(Invalidator(memcached, log).concurrent, True)
+
+    @mock.patch('caching.config.COMPRESS_MIN_SIZE', None)
+    @mock.patch('caching.config.REDIS_FILL_PIPELINE', True)
+    def test_redis_fill_pipeline(self):
+        inv = self._redis_invalidator()
+        inv.cache.default_timeout = 300
+        inv.cache.client.encode.side_effect = pickle.dumps
+        pipe = inv.client.pipeline.return_value
+        pipe.execute.return_value = [True, True, 1]
+        stats = dict(inv.fill_stats)
+        with inv.fill():
+            self.assertIsNone(inv.add('q', [1], timeout=60))
+            inv.set_many({'byid:o:1': 1})
+            inv.add_to_flush_list({'flush:o:1': ['q']})
+        inv.client.pipeline.assert_called_once_with(transaction=False)
+        pipe.set.assert_any_call(':1:ormcache:q', pickle.dumps([1]), px=60000, nx=True)
+        pipe.set.assert_any_call(':1:ormcache:byid:o:1', pickle.dumps(1), px=300000, nx=False)
+        pipe.sadd.assert_called_once_with('ormcache:flush:o:1', b'q')
+        pipe.execute.assert_called_once_with()
+        self.assertEqual(inv.fill_stats['fills'], stats.get('fills', 0) + 1)
+        self.assertEqual(inv.fill_stats['round_trips'], stats.get('round_trips', 0) + 1)
+        self.assertFalse(inv.cache.add.called)
+
+    @mock.patch('caching.config.REDIS_FLUSH_SCRIPT', True)
+    def test_redis_flush_script_other_backend(self):
+        """The script can't delete values cached outside of our Redis."""
+        cache_mock = mock.Mock(spec=['make_key', 'delete_many', '_client'])
+        cache_mock.make_key.side_effect = lambda key: ':1:%s' % key
+        inv = RedisInvalidator(cache=cache_mock, logger=log)
+        self.assertIsNone(inv.key_template)
+
+        cache_mock = mock.Mock(spec=['make_key', 'delete_many', 'client', '_client'])
+        cache_mock.make_key.side_effect = lambda key: ':1:%s' % key
+        inv = RedisInvalidator(cache=cache_mock, logger=log)
+        self.assertIsNone(inv.key_template)
+
+        inv.client.sunion.return_value = []
+        inv.invalidate_keys(['o:1'], ['flush:o:1'])
+        self.assertFalse(inv.flush_script.called)
+        cache_mock.delete_many.assert_called_once_with(['ormcache:o:1'])
+
+    def test_redis_flush_script_off(self):
+        inv = self._redis_invalidator()
+        inv.client.sunion.return_value = []
+        inv.invalidate_keys(['o:1'], ['flush:o:1'])
+        self.assertFalse(inv.flush_script.called)
+        self.assertTrue(inv.client.sunion.called)
+
+    def _use_generations(self):
+        inv = GenerationInvalidator(cache=cache, logger=log)
+        for target in ('caching.base.invalidator', 'caching.deferred.invalidator'):
+            patcher = mock.patch(target, inv)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return inv
+
+    def test_generations(self):
+        self._use_generations()
+        Addon.objects.get(id=1)
+        list(Addon.objects.filter(id=2))
+        list(Addon.objects.all())
+        list(User.objects.all())
+        with mock.patch.object(cache, 'set_many') as set_many:
+            Addon.objects.get(id=1).save()
+        # No flush lists to write to.
+        self.assertFalse(set_many.called)
+        self.assertEqual(Addon.objects.get(id=1).from_cache, False)
+        self.assertEqual([a.from_cache for a in Addon.objects.all()], [False, False])
+        # Other objects and models keep their generation.
+        self.assertEqual([a.from_cache for a in Addon.objects.filter(id=2)], [True])
+        self.assertEqual([u.from_cache for u in User.objects.all()], [True, True])
+
+    @mock.patch('caching.config.OBJECT_LOOKUPS', True)
+    def test_generations_object_lookups(self):
+        self._use_generations()
+        self.test_object_lookups_unique()
+
+    @mock.patch('caching.config.OBJECT_LOOKUPS', True)
+    def test_generations_cross_locale(self):
+        self._use_generations()
+        old_locale = translation.get_language()
+        self.addCleanup(translation.activate, old_locale)
+        translation.activate('fr')
+        self.assertIs(Addon.objects.get(pk=1).from_cache, False)
+        self.assertIs(Addon.objects.get(pk=1).from_cache, True)
+
+        translation.activate('en')
+        a = Addon.objects.get(pk=1)
+        a.val = 7
+        a.save()
+
+        translation.activate('fr')
+        a = Addon.objects.get(pk=1)
+        self.assertEqual((a.val, a.from_cache), (7, False))
+
+    def test_generations_in_bulk(self):
+        self._use_generations()
+        self.test_in_bulk()
+
+    def test_generations_foreign_keys(self):
+        self._use_generations()
+        self.test_foreign_keys()
+
+    def test_generations_related(self):
+        self._use_generations()
+        list(Addon.objects.filter(author1__in=User.objects.filter(id=1)))
+        list(Addon.objects.filter(author1__name='fliggy'))
+        User.objects.get(id=1).save()
+        self.assertFalse(any(a.from_cache for a in
+                             Addon.objects.filter(author1__in=User.objects.filter(id=1))))
+        self.assertFalse(any(a.from_cache for a in Addon.objects.filter(author1__name='fliggy')))
+
+    def test_generations_select_related(self):
+        self._use_generations()
+        list(Addon.objects.select_related('author1'))
+        u = User.objects.get(id=2)
+        u.name = 'new'
+        u.save()
+        addons = Addon.objects.select_related('author1')
+        self.assertEqual([(a.author1.name, a.from_cache) for a in addons],
+                         [('new', False), ('new', False)])
+
+    def test_generations_cached_with(self):
+        self._use_generations()
+        a = Addon.objects.get(id=1)
+        f = mock.Mock(return_value=1)
+        base.cached_with(a, f, 'key')
+        base.cached_with(a, f, 'key')
+        self.assertEqual(f.call_count, 1)
+        a.save()
+        base.cached_with(a, f, 'key')
+        self.assertEqual(f.call_count, 2)
+
+    @mock.patch('caching.config.BULK_INVALIDATE_MAX_ROWS', 0)
+    def test_generations_model_keys(self):
+        inv = self._use_generations()
+        Addon.objects.get(id=2)
+        with mock.patch.object(inv, 'bump', wraps=inv.bump) as bump:
+            Addon.objects.filter(id=1).update(val=7)
+        self.assertEqual(set(c[0][0] for c in bump.call_args_list),
+                         set(inv.model_keys(Addon)))
+        # Primary key lookups go with the model epoch.
+        self.assertEqual(Addon.objects.get(id=2).from_cache, False)
+
+    def test_query_columns(self):
+        columns = dependencies.query_columns
+        self.assertEqual(columns(Addon.objects.only('author1').filter(val=1).query),
+                         {'testapp.addon': set(['id', 'author1', 'val'])})
+        self.assertEqual(columns(Addon.objects.filter(author1__name='a').query),
+                         {'testapp.addon': None, 'testapp.user': set(['name'])})
+        self.assertEqual(columns(User.objects.order_by('addon__val').query),
+                         {'testapp.user': None, 'testapp.addon': None})
+        self.assertEqual(columns(Addon.objects.extra(where=['val = 1']).query), None)
+
+    @mock.patch('caching.config.FIELD_INVALIDATION', True)
+    def test_field_invalidation(self):
+        list(User.objects.all())
+        list(Addon.objects.only('author1'))
+        list(Addon.objects.filter(val=42))
+        a = Addon.objects.get(id=1)
+        a.save(update_fields=['val'])
+        # Neither the authors nor val were loaded.
+        self.assertEqual([u.from_cache for u in User.objects.all()], [True, True])
+        self.assertEqual([a.from_cache for a in Addon.objects.only('author1')], [True, True])
+        self.assertEqual([a.from_cache for a in Addon.objects.filter(val=42)], [False, False])
+        self.assertEqual(Addon.objects.get(id=1).from_cache, False)
+
+    @mock.patch('caching.config.FIELD_INVALIDATION', True)
+    def test_field_invalidation_foreign_key(self):
+        list(User.objects.all())
+        a = Addon.objects.get(id=1)
+        a.save(update_fields=['author1'])
+        self.assertEqual([u.from_cache for u in User.objects.all()], [False, False])
+
+    @mock.patch('caching.config.FIELD_INVALIDATION', True)
+    def test_field_invalidation_unknown_query(self):
+        list(User.objects.all())
+        # Evicted, or cached before CACHE_FIELD_INVALIDATION was on.
+        cache.delete(invalidation.invalidator.make_key(
+            columns_key(User.objects.all().flush_key())))
+        if invalidation.local is not None:
+            invalidation.local.clear()
+        Addon.objects.get(id=1).save(update_fields=['val'])
+        self.assertEqual([u.from_cache for u in User.objects.all()], [False, False])
+
 
 # use TransactionTestCase so that ['TEST']['MIRROR'] setting works
 # see https://code.djangoproject.com/ticket/23718
@@ -631,3 +1694,44 @@ class MultiDbTestCase(TransactionTestCase):
         self.assertIs(master_obj2.from_cache, True)
         # ensure no crossover between databases
         self.assertNotEqual(master_obj.name, master_obj2.name)
+
+
+@mock.patch('caching.config.INVALIDATE_ON_COMMIT', True)
+class DeferredInvalidationTestCase(TransactionTestCase):
+    fixtures = ['test_cache.json']
+
+    def setUp(self):
+        cache.clear()
+        if invalidation.local is not None:
+            invalidation.local.clear()
+
+    def test_invalidate_on_commit(self):
+        keys = set(k for a in Addon.objects.all() for k in a._cache_keys())
+        with mock.patch.object(base.invalidator, 'invalidate_keys',
+                               wraps=base.invalidator.invalidate_keys) as invalidate:
+            with transaction.atomic():
+                for addon in Addon.objects.all():
+                    addon.save()
+                    addon.save()
+                self.assertFalse(invalidate.called)
+                self.assertTrue(all(a.from_cache for a in Addon.objects.all()))
+            # Once, for everything.
+            self.assertEqual(invalidate.call_count, 1)
+            obj_keys, flush_keys = invalidate.call_args[0]
+            self.assertEqual(obj_keys, keys)
+        self.assertFalse(any(a.from_cache for a in Addon.objects.all()))
+
+    def test_invalidate_on_rollback(self):
+        with mock.patch.object(base.invalidator, 'invalidate_keys') as invalidate:
+            try:
+                with transaction.atomic():
+                    Addon.objects.get(id=1).save()
+                    raise ValueError
+            except ValueError:
+                pass
+            self.assertFalse(invalidate.called)
+
+    def test_invalidate_outside_transaction(self):
+        list(Addon.objects.all())
+        Addon.objects.get(id=1).save()
+        self.assertFalse(any(a.from_cache for a in Addon.objects.all()))
@@ -17,6 +17,7 @@ call_counter = mock.Mock()
 
 class User(CachingMixin, models.Model):
     name = models.CharField(max_length=30)
+    email = models.EmailField(unique=True, null=True)
 
     objects = CachingManager()
 
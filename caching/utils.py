@@ -26,5 +26,7 @@ def flush_key(obj):
 
 
 def byid(obj):
+    # Objects are the same in every locale, as are the query results holding
+    # them, and saving one has to reach its entry whatever the locale.
     key = obj if isinstance(obj, six.string_types) else obj.cache_key
-    return make_key("byid:" + key)
+    return make_key("byid:" + key, with_locale=False)